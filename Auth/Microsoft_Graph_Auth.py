@@ -1,5 +1,64 @@
+import json
+import os
+import threading
+import time
+
 from msal import ConfidentialClientApplication
 
+# Tokens compartidos entre requests: (tenant_id, client_id, scope) -> (access_token, expires_at epoch)
+_TOKEN_CACHE: dict[tuple, tuple[str, float]] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+# Margen antes de la expiración real para renovar el token
+_TOKEN_REFRESH_MARGIN = 60
+# Archivo opcional para reutilizar tokens entre procesos (scripts de prueba, workers); vacío = solo en memoria
+_TOKEN_CACHE_FILE = os.getenv("GRAPH_TOKEN_CACHE_FILE", "")
+# Apps MSAL compartidas: (tenant_id, client_id, client_secret) -> ConfidentialClientApplication.
+# Construir una hace discovery de la authority por red, así que se crean una sola vez y solo si hace falta un token.
+_MSAL_APPS: dict[tuple, ConfidentialClientApplication] = {}
+
+
+def _clave_archivo(key: tuple) -> str:
+    return "|".join(key)
+
+
+def _leer_token_archivo(key: tuple):
+    """Busca un token vigente en el archivo de caché; None si no hay o no se puede leer."""
+    try:
+        with open(_TOKEN_CACHE_FILE, "r", encoding="utf-8") as f:
+            entry = json.load(f).get(_clave_archivo(key))
+        return (entry[0], float(entry[1])) if entry else None
+    except (OSError, ValueError, AttributeError, TypeError, IndexError):
+        return None
+
+
+def _guardar_token_archivo(key: tuple, token: str, expires_at: float) -> None:
+    """Escribe el token en el archivo de caché (permisos 0600); los errores de IO se ignoran."""
+    try:
+        try:
+            with open(_TOKEN_CACHE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                data = {}
+        except (OSError, ValueError):
+            data = {}
+        now = time.time()
+        data = {k: v for k, v in data.items() if float(v[1]) > now}
+        data[_clave_archivo(key)] = [token, expires_at]
+
+        directorio = os.path.dirname(_TOKEN_CACHE_FILE)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        tmp = f"{_TOKEN_CACHE_FILE}.{os.getpid()}.tmp"
+        # El token es una credencial: el archivo se crea ya con 0600, nunca legible por otros
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, _TOKEN_CACHE_FILE)
+    except (OSError, TypeError, ValueError, IndexError):
+        pass
+
+
 class MicrosoftGraphAuthenticator:
     def __init__(self, tenant_id: str, client_id: str, client_secret: str):
         self.tenant_id = tenant_id
@@ -8,15 +67,39 @@ class MicrosoftGraphAuthenticator:
         self.authority = f"https://login.microsoftonline.com/{tenant_id}"
         self.scope = ["https://graph.microsoft.com/.default"]
 
-        self.app = ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=self.authority
-        )
+    @property
+    def app(self) -> ConfidentialClientApplication:
+        key = (self.tenant_id, self.client_id, self.client_secret)
+        with _TOKEN_CACHE_LOCK:
+            app = _MSAL_APPS.get(key)
+        if app is None:
+            app = ConfidentialClientApplication(
+                client_id=self.client_id,
+                client_credential=self.client_secret,
+                authority=self.authority
+            )
+            with _TOKEN_CACHE_LOCK:
+                app = _MSAL_APPS.setdefault(key, app)
+        return app
 
     def get_access_token(self) -> str:
+        key = (self.tenant_id, self.client_id, " ".join(self.scope))
+        with _TOKEN_CACHE_LOCK:
+            cached = _TOKEN_CACHE.get(key)
+            if cached is None and _TOKEN_CACHE_FILE:
+                cached = _leer_token_archivo(key)
+                if cached:
+                    _TOKEN_CACHE[key] = cached
+            if cached and cached[1] - time.time() > _TOKEN_REFRESH_MARGIN:
+                return cached[0]
+
         result = self.app.acquire_token_for_client(scopes=self.scope)
         if "access_token" in result:
+            expires_at = time.time() + int(result.get("expires_in") or 0)
+            with _TOKEN_CACHE_LOCK:
+                _TOKEN_CACHE[key] = (result["access_token"], expires_at)
+                if _TOKEN_CACHE_FILE:
+                    _guardar_token_archivo(key, result["access_token"], expires_at)
             return result["access_token"]
         else:
-            raise Exception(f"Error al obtener token: {result.get('error_description')}")
\ No newline at end of file
+            raise Exception(f"Error al obtener token: {result.get('error_description')}")
@@ -14,7 +14,17 @@ DB_NAME = os.getenv("DB_NAME")
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 # echo=True para ver SQL en consola; ponlo en False en prod
-engine = create_engine(DATABASE_URL, echo=True)
+# Pool de conexiones reutilizadas entre requests (evita handshake TCP/TLS por request).
+# pool_pre_ping descarta conexiones muertas; pool_recycle las renueva antes de timeouts del servidor.
+engine = create_engine(
+    DATABASE_URL,
+    echo=True,
+    pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+    pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=True,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
@@ -19,9 +19,80 @@ from Postgress.Tables import (
     RenderStatus
 )
 from Auth.Microsoft_Graph_Auth import MicrosoftGraphAuthenticator
+from collections import OrderedDict
 from datetime import datetime
+from operator import itemgetter
+import threading
+import time
 import uuid
 
+# (client_key, drive_id, target_user_id, file_path) -> (expira_en monotonic, item_id, hojas).
+# Evita resolver el item y listar las hojas en cada operación sobre el mismo archivo.
+_WORKBOOK_CACHE: "OrderedDict[tuple, Tuple[float, str, list]]" = OrderedDict()
+_WORKBOOK_CACHE_LOCK = threading.Lock()
+_WORKBOOK_CACHE_MAX = 32
+_WORKBOOK_CACHE_TTL = 60
+
+
+def _buscar_en_valores(values: list, row_offset: int, col_offset: int, marker: str) -> Tuple[Optional[int], Optional[int]]:
+    """Busca el marcador en los valores de un usedRange y devuelve (fila, columna) 1-based."""
+    for row_idx, row in enumerate(values):
+        for col_idx, cell_value in enumerate(row):
+            if cell_value and marker in str(cell_value):
+                return (row_offset + row_idx + 1, col_offset + col_idx + 1)
+    return (None, None)
+
+
+def _matriz_tabla(datos: List[Dict[str, Any]], columnas: Dict[str, int]) -> List[list]:
+    """Arma la matriz de valores (filas x columnas) a partir de la lista de dicts."""
+    num_columnas = len(columnas)
+    keys = sorted(columnas, key=columnas.get)
+    if num_columnas > 1 and [columnas[k] for k in keys] == list(range(num_columnas)):
+        # Offsets contiguos 0..n-1: itemgetter extrae la fila completa en C; si falta algún
+        # campo en la fila se cae a dict.get (None para los faltantes)
+        getter = itemgetter(*keys)
+        matriz = []
+        for fila_datos in datos:
+            try:
+                matriz.append(list(getter(fila_datos)))
+            except KeyError:
+                matriz.append([fila_datos.get(k) for k in keys])
+        return matriz
+    
+    matriz = [[None] * num_columnas for _ in range(len(datos))]
+    for row_idx, fila_datos in enumerate(datos):
+        for campo, valor in fila_datos.items():
+            if campo in columnas:
+                matriz[row_idx][columnas[campo]] = valor
+    return matriz
+
+
+def _fila_campos(datos: Dict[str, Any], columnas: Dict[str, int]) -> Tuple[Optional[int], list, List[str]]:
+    """
+    Arma una sola fila contigua con los campos presentes en columnas.
+    Devuelve (offset_inicial, valores, campos_escritos); los huecos van en None,
+    que Graph ignora al actualizar un rango (no pisa esas celdas).
+    """
+    por_offset = {columnas[campo]: (campo, valor) for campo, valor in datos.items() if campo in columnas}
+    if not por_offset:
+        return None, [], []
+    inicio, fin = min(por_offset), max(por_offset)
+    valores = [por_offset[off][1] if off in por_offset else None for off in range(inicio, fin + 1)]
+    campos = [campo for campo in datos if campo in columnas]
+    return inicio, valores, campos
+
+
+def _rangos_merge(merge_ranges: List[str], fila_inicio: int, num_filas: int) -> List[str]:
+    """Expande merges por columna ("A:C") a un rango por fila ("A5:C5")."""
+    rangos = []
+    for i in range(num_filas):
+        fila_actual = fila_inicio + i
+        for merge_range in merge_ranges:
+            if ":" in merge_range:
+                col_inicio_merge, col_fin_merge = merge_range.split(":")
+                rangos.append(f"{col_inicio_merge}{fila_actual}:{col_fin_merge}{fila_actual}")
+    return rangos
+
 
 class ExcelLiveWriter:
     """Wrapper para operaciones de Excel usando Graph API con configuración desde DB."""
@@ -38,6 +109,11 @@ class ExcelLiveWriter:
         self.correlation_id = correlation_id
         self.db = SessionLocal()
         self.client = self._init_graph_client()
+        # (item_id, ws_id, marker_text) -> (fila, columna); vale mientras dura el writer y
+        # se invalida por hoja cuando insertar_filas desplaza filas
+        self._marker_cache: Dict[tuple, Tuple[int, int]] = {}
+        # URL del item -> id de la sesión de workbook abierta; se cierran en close()
+        self._workbook_sessions: Dict[str, str] = {}
     
     def _init_graph_client(self) -> GraphServices:
         """Inicializa el cliente de Graph API."""
@@ -58,9 +134,18 @@ class ExcelLiveWriter:
         return GraphServices(access_token=token, correlation_id=self.correlation_id)
     
     def close(self):
-        """Cierra la sesión de base de datos."""
+        """Cierra las sesiones de workbook, la sesión de base de datos y el cliente de Graph."""
+        if self.client:
+            for base, session_id in self._workbook_sessions.items():
+                try:
+                    self.client.close_workbook_session(base, session_id)
+                except Exception as e:
+                    print(f"⚠ Error cerrando sesión de workbook: {e}")
+            self._workbook_sessions.clear()
         if self.db:
             self.db.close()
+        if self.client:
+            self.client.close()
     
     def __enter__(self):
         return self
@@ -113,6 +198,54 @@ class ExcelLiveWriter:
         
         return excel_file, section, fields, storage, file_path, drive_id, target_user_id
     
+    def _resolve_workbook(self, file_path: str, drive_id: str = None, target_user_id: str = None) -> Tuple[str, list]:
+        """Devuelve (item_id, hojas) del archivo, reutilizando lo resuelto en los últimos segundos."""
+        key = (self.client_key, drive_id, target_user_id, file_path)
+        now = time.monotonic()
+        with _WORKBOOK_CACHE_LOCK:
+            cached = _WORKBOOK_CACHE.get(key)
+            if cached and cached[0] > now:
+                _WORKBOOK_CACHE.move_to_end(key)
+                return cached[1], cached[2]
+        
+        item_id, _ = self.client._resolve_item_id(file_path, target_user_id=target_user_id, drive_id=drive_id)
+        sheets, _ = self.client._resolve_worksheets(item_id=item_id, target_user_id=target_user_id, drive_id=drive_id)
+        
+        with _WORKBOOK_CACHE_LOCK:
+            _WORKBOOK_CACHE[key] = (now + _WORKBOOK_CACHE_TTL, item_id, sheets)
+            _WORKBOOK_CACHE.move_to_end(key)
+            while len(_WORKBOOK_CACHE) > _WORKBOOK_CACHE_MAX:
+                _WORKBOOK_CACHE.popitem(last=False)
+        return item_id, sheets
+    
+    def _invalidar_marcadores(self, item_id: str, ws_id: str):
+        """Descarta las posiciones de marcadores cacheadas para una hoja."""
+        for key in [k for k in self._marker_cache if k[0] == item_id and k[1] == ws_id]:
+            del self._marker_cache[key]
+    
+    def _usar_sesion(self, base: str) -> Optional[str]:
+        """
+        Devuelve el id de la sesión de workbook del item, abriéndola la primera vez: el workbook
+        queda abierto en el servidor entre llamadas en lugar de abrirse en cada una.
+        Si no se puede abrir devuelve None y se sigue sin sesión.
+        """
+        session_id = self._workbook_sessions.get(base)
+        if session_id is None:
+            try:
+                session_id = self.client.create_workbook_session(base, persist_changes=True)
+            except Exception as e:
+                print(f"      ⚠ Sin sesión de workbook: {e}")
+                return None
+            self._workbook_sessions[base] = session_id
+        return session_id
+    
+    def _headers_sesion(self, session_id: Optional[str]) -> Dict[str, str]:
+        """Headers del cliente más el de la sesión de workbook, si hay una."""
+        headers = self.client._headers()
+        if session_id:
+            headers["workbook-session-id"] = session_id
+        return headers
+    
     def _get_template(self, template_key: str = None):
         """Obtiene un template. Si no se especifica template_key, usa el único activo."""
         query = self.db.query(Templates).filter_by(
@@ -211,8 +344,7 @@ class ExcelLiveWriter:
         
         print(f"🔍 Buscando '{marker}'...")
         
-        item_id, _ = self.client._resolve_item_id(file_path, target_user_id=target_user_id, drive_id=drive_id)
-        sheets, _ = self.client._resolve_worksheets(item_id=item_id, target_user_id=target_user_id, drive_id=drive_id)
+        item_id, sheets = self._resolve_workbook(file_path, drive_id, target_user_id)
         
         if not sheets:
             raise ValueError("No se encontraron hojas")
@@ -230,36 +362,35 @@ class ExcelLiveWriter:
             base = f"{self.client.graph_url}/drives/{drive_id}/items/{item_id}"
         else:
             base = f"{self.client.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+        sesion = self._usar_sesion(base)
         
-        url = f"{base}/workbook/worksheets/{ws_id}/usedRange"
-        resp, _ = self.client._request_with_retry("GET", url, expected=(200,), headers=self.client._headers())
-        
-        data = resp.json()
-        values = data.get("values", [])
-        row_offset = data.get("rowIndex", 0)
-        col_offset = data.get("columnIndex", 0)
-        
-        for row_idx, row in enumerate(values):
-            for col_idx, cell_value in enumerate(row):
-                if cell_value and marker in str(cell_value):
-                    fila = row_offset + row_idx + 1
-                    columna = col_offset + col_idx + 1
-                    print(f"   ✓ Encontrado en fila {fila}, columna {columna}")
-                    
-                    duration = int((datetime.now() - start_time).total_seconds() * 1000)
-                    self._log_operation(
-                        op_type=OperationType.search_marker,
-                        excel_file_id=excel_file.id,
-                        section_id=section.id,
-                        sheet_name=sheet_name,
-                        marker_text=marker,
-                        marker_found=True,
-                        marker_position=f"{fila},{columna}",
-                        status=RenderStatus.success,
-                        duration_ms=duration
-                    )
-                    
-                    return (fila, columna)
+        cache_key = (item_id, ws_id, marker)
+        fila, columna = self._marker_cache.get(cache_key, (None, None))
+        if not fila:
+            url = f"{base}/workbook/worksheets/{ws_id}/usedRange"
+            resp, _ = self.client._request_with_retry("GET", url, expected=(200,), headers=self._headers_sesion(sesion))
+            
+            data = resp.json()
+            fila, columna = _buscar_en_valores(data.get("values", []), data.get("rowIndex", 0), data.get("columnIndex", 0), marker)
+            if fila:
+                self._marker_cache[cache_key] = (fila, columna)
+        if fila:
+            print(f"   ✓ Encontrado en fila {fila}, columna {columna}")
+            
+            duration = int((datetime.now() - start_time).total_seconds() * 1000)
+            self._log_operation(
+                op_type=OperationType.search_marker,
+                excel_file_id=excel_file.id,
+                section_id=section.id,
+                sheet_name=sheet_name,
+                marker_text=marker,
+                marker_found=True,
+                marker_position=f"{fila},{columna}",
+                status=RenderStatus.success,
+                duration_ms=duration
+            )
+            
+            return (fila, columna)
         
         duration = int((datetime.now() - start_time).total_seconds() * 1000)
         self._log_operation(
@@ -299,8 +430,7 @@ class ExcelLiveWriter:
         if not marker_row:
             raise ValueError(f"No se encontró '{section.marker_text}'")
         
-        item_id, _ = self.client._resolve_item_id(file_path, target_user_id=target_user_id, drive_id=drive_id)
-        sheets, _ = self.client._resolve_worksheets(item_id=item_id, target_user_id=target_user_id, drive_id=drive_id)
+        item_id, sheets = self._resolve_workbook(file_path, drive_id, target_user_id)
         
         if section.sheet_name:
             sheet = next((s for s in sheets if s.get("name") == section.sheet_name), None)
@@ -316,33 +446,32 @@ class ExcelLiveWriter:
             base = f"{self.client.graph_url}/drives/{drive_id}/items/{item_id}"
         else:
             base = f"{self.client.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+        sesion = self._usar_sesion(base)
         
         print(f"   Escribiendo {len(datos)} campos...")
         cells_written = 0
         errors = []
         
-        for campo, valor in datos.items():
-            if campo not in columnas:
-                continue
-            
-            col_offset = columnas[campo]
-            col_destino = marker_col + section.column_offset + col_offset
-            col_letter = _col_index_to_letters(col_destino)
-            
-            cell_address = f"{ws_name}!{col_letter}{fila_destino}"
-            url = f"{base}/workbook/worksheets/{ws_id}/range(address='{cell_address}')"
-            
+        # Todos los campos van en la misma fila: un solo PATCH sobre el rango que los cubre
+        offset_inicio, valores, campos = _fila_campos(datos, columnas)
+        if campos:
+            col_inicio = marker_col + section.column_offset + offset_inicio
+            range_address = (
+                f"{ws_name}!{_col_index_to_letters(col_inicio)}{fila_destino}:"
+                f"{_col_index_to_letters(col_inicio + len(valores) - 1)}{fila_destino}"
+            )
+            url = f"{base}/workbook/worksheets/{ws_id}/range(address='{range_address}')"
             try:
                 self.client._request_with_retry(
                     "PATCH", url, expected=(200,),
-                    headers=self.client._headers(),
-                    json={"values": [[valor]]}
+                    headers=self._headers_sesion(sesion),
+                    json={"values": [valores]}
                 )
-                print(f"      ✓ {campo}")
-                cells_written += 1
+                print(f"      ✓ {', '.join(campos)}")
+                cells_written = len(campos)
             except Exception as e:
-                print(f"      ✗ {campo}: {e}")
-                errors.append({"field": campo, "error": str(e)})
+                print(f"      ✗ {range_address}: {e}")
+                errors.append({"fields": campos, "error": str(e)})
         
         duration = int((datetime.now() - start_time).total_seconds() * 1000)
         self._log_operation(
@@ -352,7 +481,7 @@ class ExcelLiveWriter:
             sheet_name=ws_name,
             cells_affected=cells_written,
             input_data={"section_key": section_key, "fields": list(datos.keys())},
-            status=RenderStatus.success if not errors else RenderStatus.partial,
+            status=RenderStatus.success if not errors else RenderStatus.error,
             error_message=str(errors) if errors else None,
             duration_ms=duration
         )
@@ -383,8 +512,7 @@ class ExcelLiveWriter:
         if not marker_row:
             raise ValueError(f"No se encontró '{section.marker_text}'")
         
-        item_id, _ = self.client._resolve_item_id(file_path, target_user_id=target_user_id, drive_id=drive_id)
-        sheets, _ = self.client._resolve_worksheets(item_id=item_id, target_user_id=target_user_id, drive_id=drive_id)
+        item_id, sheets = self._resolve_workbook(file_path, drive_id, target_user_id)
         
         if section.sheet_name:
             sheet = next((s for s in sheets if s.get("name") == section.sheet_name), None)
@@ -398,13 +526,7 @@ class ExcelLiveWriter:
         num_filas = len(datos)
         num_columnas = len(columnas)
         
-        matriz = [[None] * num_columnas for _ in range(num_filas)]
-        
-        for row_idx, fila_datos in enumerate(datos):
-            for campo, valor in fila_datos.items():
-                if campo in columnas:
-                    col_offset = columnas[campo]
-                    matriz[row_idx][col_offset] = valor
+        matriz = _matriz_tabla(datos, columnas)
         
         col_inicio_letter = _col_index_to_letters(marker_col + section.column_offset)
         col_fin_letter = _col_index_to_letters(marker_col + section.column_offset + num_columnas - 1)
@@ -416,6 +538,7 @@ class ExcelLiveWriter:
             base = f"{self.client.graph_url}/drives/{drive_id}/items/{item_id}"
         else:
             base = f"{self.client.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+        sesion = self._usar_sesion(base)
         
         url = f"{base}/workbook/worksheets/{ws_id}/range(address='{range_address}')"
         
@@ -424,7 +547,7 @@ class ExcelLiveWriter:
         try:
             self.client._request_with_retry(
                 "PATCH", url, expected=(200,),
-                headers=self.client._headers(),
+                headers=self._headers_sesion(sesion),
                 json={"values": matriz}
             )
             print(f"      ✓ {num_filas} filas escritas")
@@ -460,25 +583,17 @@ class ExcelLiveWriter:
             try:
                 print(f"      Aplicando merges...")
                 
-                for i in range(num_filas):
-                    fila_actual = fila_inicio + i
-                    
-                    for merge_range in section.merge_ranges:
-                        if ":" in merge_range:
-                            col_inicio_merge, col_fin_merge = merge_range.split(":")
-                            rango_merge = f"{col_inicio_merge}{fila_actual}:{col_fin_merge}{fila_actual}"
-                        else:
-                            continue
-                        
-                        merge_url = f"{base}/workbook/worksheets/{ws_id}/range(address='{rango_merge}')/merge"
-                        try:
-                            self.client._request_with_retry(
-                                "POST", merge_url, expected=(200, 204),
-                                headers=self.client._headers(),
-                                json={"across": True}
-                            )
-                        except Exception as e_merge:
-                            print(f"      ⚠ No se pudo mergear {rango_merge}")
+                rangos = _rangos_merge(section.merge_ranges, fila_inicio, num_filas)
+                llamadas = [
+                    ("POST", f"{base}/workbook/worksheets/{ws_id}/range(address='{rango_merge}')/merge", (200, 204), {"across": True})
+                    for rango_merge in rangos
+                ]
+                
+                # Cada merge afecta un rango distinto: se agrupan en /$batch
+                errores, _ = self.client.batch_requests(llamadas, workbook_session_id=sesion)
+                for rango_merge, error in zip(rangos, errores):
+                    if error is not None:
+                        print(f"      ⚠ No se pudo mergear {rango_merge}")
                 
                 print(f"      ✓ Merges aplicados")
             except Exception as e_merges:
@@ -515,8 +630,7 @@ class ExcelLiveWriter:
         
         columnas = {field.field_key: field.column_offset for field in fields}
         
-        item_id, _ = self.client._resolve_item_id(file_path, target_user_id=target_user_id, drive_id=drive_id)
-        sheets, _ = self.client._resolve_worksheets(item_id=item_id, target_user_id=target_user_id, drive_id=drive_id)
+        item_id, sheets = self._resolve_workbook(file_path, drive_id, target_user_id)
         
         if section.sheet_name:
             sheet = next((s for s in sheets if s.get("name") == section.sheet_name), None)
@@ -532,17 +646,12 @@ class ExcelLiveWriter:
             base = f"{self.client.graph_url}/drives/{drive_id}/items/{item_id}"
         else:
             base = f"{self.client.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+        sesion = self._usar_sesion(base)
         
         num_filas = len(datos)
         num_columnas = len(columnas)
         
-        matriz = [[None] * num_columnas for _ in range(num_filas)]
-        
-        for row_idx, fila_datos in enumerate(datos):
-            for campo, valor in fila_datos.items():
-                if campo in columnas:
-                    col_offset = columnas[campo]
-                    matriz[row_idx][col_offset] = valor
+        matriz = _matriz_tabla(datos, columnas)
         
         columna_inicio = section.column_offset + 1
         col_inicio_letter = _col_index_to_letters(columna_inicio)
@@ -553,29 +662,46 @@ class ExcelLiveWriter:
         
         print(f"   Insertando {num_filas} filas...")
         
+        # Insertar desplaza las filas de la hoja: los marcadores cacheados ya no son válidos
+        self._invalidar_marcadores(item_id, ws_id)
+        
+        url = f"{base}/workbook/worksheets/{ws_id}/range(address='{range_simple}')"
+        row_range = f"{fila_inicio}:{fila_inicio}"
+        insert_url = f"{base}/workbook/worksheets/{ws_id}/range(address='{row_range}')/insert"
+        merges = [
+            ("POST", f"{base}/workbook/worksheets/{ws_id}/range(address='{rango_merge}')/merge", (200, 204), {"across": True})
+            for rango_merge in _rangos_merge(section.merge_ranges or [], fila_inicio, num_filas)
+        ]
+        
+        # Inserts (uno por fila) -> valores -> merges en una sola cadena secuencial de /$batch:
+        # si entra en un lote de 20 es un único round-trip. batch_requests corta la cadena en el
+        # primer error (también entre lotes), así que tras un insert fallido no se insertan más
+        # filas ni se escriben valores/merges; se cae a la escritura directa, igual que antes.
+        llamadas = [("POST", insert_url, (200, 201), {"shift": "Down"})] * num_filas
+        llamadas.append(("PATCH", url, (200,), {"values": matriz}))
+        llamadas.extend(merges)
+        
         inserted = False
+        error_valores = None
+        errores_merge = []
         try:
-            for i in range(num_filas):
-                row_range = f"{fila_inicio}:{fila_inicio}"
-                insert_url = f"{base}/workbook/worksheets/{ws_id}/range(address='{row_range}')/insert"
-                
-                self.client._request_with_retry(
-                    "POST", insert_url, expected=(200, 201),
-                    headers=self.client._headers(),
-                    json={"shift": "Down"}
-                )
+            errores, _ = self.client.batch_requests(llamadas, sequential=True, workbook_session_id=sesion)
+            error = next((e for e in errores[:num_filas] if e is not None), None)
+            if error is not None:
+                raise error
             print(f"      ✓ Filas insertadas")
             inserted = True
+            error_valores = errores[num_filas]
+            errores_merge = [e for e in errores[num_filas + 1:] if e is not None]
         except Exception as e1:
             print(f"      ⚠ Error insertando: {e1}")
         
         if not inserted:
             print(f"      Usando escritura directa...")
             try:
-                url = f"{base}/workbook/worksheets/{ws_id}/range(address='{range_simple}')"
                 self.client._request_with_retry(
                     "PATCH", url, expected=(200,),
-                    headers=self.client._headers(),
+                    headers=self._headers_sesion(sesion),
                     json={"values": matriz}
                 )
                 print(f"      ✓ Datos escritos")
@@ -583,30 +709,8 @@ class ExcelLiveWriter:
             except Exception as e3:
                 raise Exception(f"No se pudo insertar: {e3}")
         
-        url = f"{base}/workbook/worksheets/{ws_id}/range(address='{range_simple}')"
-        
-        try:
-            self.client._request_with_retry(
-                "PATCH", url, expected=(200,),
-                headers=self.client._headers(),
-                json={"values": matriz}
-            )
-            print(f"      ✓ Datos escritos")
-            
-            duration = int((datetime.now() - start_time).total_seconds() * 1000)
-            self._log_operation(
-                op_type=OperationType.insert_rows,
-                excel_file_id=excel_file.id,
-                section_id=section.id,
-                sheet_name=ws_name,
-                rows_affected=num_filas,
-                cells_affected=num_filas * num_columnas,
-                input_data={"section_key": section_key, "fila_inicio": fila_inicio, "row_count": num_filas},
-                status=RenderStatus.success,
-                duration_ms=duration
-            )
-        except Exception as e:
-            duration = int((datetime.now() - start_time).total_seconds() * 1000)
+        duration = int((datetime.now() - start_time).total_seconds() * 1000)
+        if error_valores is not None:
             self._log_operation(
                 op_type=OperationType.insert_rows,
                 excel_file_id=excel_file.id,
@@ -614,51 +718,62 @@ class ExcelLiveWriter:
                 sheet_name=ws_name,
                 input_data={"section_key": section_key, "fila_inicio": fila_inicio, "row_count": num_filas},
                 status=RenderStatus.error,
-                error_message=str(e),
+                error_message=str(error_valores),
                 duration_ms=duration
             )
-            print(f"      ✗ Error: {e}")
-            raise
+            print(f"      ✗ Error: {error_valores}")
+            raise error_valores
         
-        if section.merge_ranges and len(section.merge_ranges) > 0:
-            try:
-                print(f"      Aplicando merges...")
-                
-                for i in range(num_filas):
-                    fila_actual = fila_inicio + i
-                    
-                    for merge_range in section.merge_ranges:
-                        if ":" in merge_range:
-                            col_inicio_merge, col_fin_merge = merge_range.split(":")
-                            rango_merge = f"{col_inicio_merge}{fila_actual}:{col_fin_merge}{fila_actual}"
-                        else:
-                            continue
-                        
-                        merge_url = f"{base}/workbook/worksheets/{ws_id}/range(address='{rango_merge}')/merge"
-                        try:
-                            self.client._request_with_retry(
-                                "POST", merge_url, expected=(200, 204),
-                                headers=self.client._headers(),
-                                json={"across": True}
-                            )
-                        except Exception:
-                            pass
-                
+        print(f"      ✓ Datos escritos")
+        self._log_operation(
+            op_type=OperationType.insert_rows,
+            excel_file_id=excel_file.id,
+            section_id=section.id,
+            sheet_name=ws_name,
+            rows_affected=num_filas,
+            cells_affected=num_filas * num_columnas,
+            input_data={"section_key": section_key, "fila_inicio": fila_inicio, "row_count": num_filas},
+            status=RenderStatus.success,
+            duration_ms=duration
+        )
+        
+        # Errores de merge se informan pero no hacen fallar la operación, como antes
+        if merges:
+            if errores_merge:
+                print(f"      ⚠ Error con merges: {errores_merge[0]}")
+            else:
                 print(f"      ✓ Merges aplicados")
-            except Exception as e_merges:
-                print(f"      ⚠ Error con merges: {e_merges}")
     
     def procesar_excel(self, file_key: str, secciones: Dict[str, Any]):
         """
         Procesa múltiples secciones en un archivo.
         
+        Resuelve el archivo, las hojas y el usedRange una sola vez, ubica todos los
+        marcadores localmente y envía las escrituras de todas las secciones vía
+        /$batch (20 por llamada) en lugar de una petición por celda/sección.
+        
         Args:
             file_key: Clave del archivo a editar
             secciones: {"section_key": datos}
         """
+        start_time = datetime.now()
         print(f"🔥 Procesando Excel '{file_key}'...")
         
-        excel_file, _, _, _, _, _, _ = self._get_file_context(file_key)
+        excel_file, _, _, _, file_path, drive_id, target_user_id = self._get_file_context(file_key)
+        
+        item_id, sheets = self._resolve_workbook(file_path, drive_id, target_user_id)
+        if not sheets:
+            raise ValueError("No se encontraron hojas")
+        
+        if drive_id:
+            base = f"{self.client.graph_url}/drives/{drive_id}/items/{item_id}"
+        else:
+            base = f"{self.client.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+        sesion = self._usar_sesion(base)
+        
+        used_ranges = {}  # ws_id -> (values, rowIndex, columnIndex)
+        llamadas = []
+        planes = []  # (section, section_key, datos, ws_name, num_celdas, desde, hasta, merges)
         
         for section_key, datos in secciones.items():
             print(f"\n📝 Sección: {section_key}")
@@ -674,10 +789,125 @@ class ExcelLiveWriter:
                 print(f"   ⚠ Sección no encontrada - saltando")
                 continue
             
+            fields = self.db.query(ExcelFields).filter_by(section_id=section.id, is_active=True).all()
+            if not fields:
+                raise ValueError("No hay campos definidos")
+            columnas = {field.field_key: field.column_offset for field in fields}
+            
+            if section.sheet_name:
+                sheet = next((s for s in sheets if s.get("name") == section.sheet_name), None)
+                if not sheet:
+                    raise ValueError(f"Hoja '{section.sheet_name}' no encontrada")
+            else:
+                sheet = sheets[0]
+            ws_id = sheet["id"]
+            ws_name = sheet["name"]
+            
+            cache_key = (item_id, ws_id, section.marker_text)
+            marker_row, marker_col = self._marker_cache.get(cache_key, (None, None))
+            if not marker_row:
+                if ws_id not in used_ranges:
+                    resp, _ = self.client._request_with_retry(
+                        "GET", f"{base}/workbook/worksheets/{ws_id}/usedRange",
+                        expected=(200,), headers=self._headers_sesion(sesion)
+                    )
+                    data = resp.json()
+                    used_ranges[ws_id] = (data.get("values", []), data.get("rowIndex", 0), data.get("columnIndex", 0))
+                
+                marker_row, marker_col = _buscar_en_valores(*used_ranges[ws_id], section.marker_text)
+                if marker_row:
+                    self._marker_cache[cache_key] = (marker_row, marker_col)
+            if not marker_row:
+                raise ValueError(f"No se encontró '{section.marker_text}'")
+            print(f"   ✓ Marcador en fila {marker_row}, columna {marker_col}")
+            
+            desde = len(llamadas)
+            merges = []
+            fila_inicio = marker_row + section.row_offset
+            col_base = marker_col + section.column_offset
+            
             if section.is_table:
-                self.llenar_tabla(file_key, section_key, datos)
+                num_filas = len(datos)
+                col_inicio_letter = _col_index_to_letters(col_base)
+                col_fin_letter = _col_index_to_letters(col_base + len(columnas) - 1)
+                range_address = f"{ws_name}!{col_inicio_letter}{fila_inicio}:{col_fin_letter}{fila_inicio + num_filas - 1}"
+                llamadas.append((
+                    "PATCH", f"{base}/workbook/worksheets/{ws_id}/range(address='{range_address}')",
+                    (200,), {"values": _matriz_tabla(datos, columnas)}
+                ))
+                num_celdas = num_filas * len(columnas)
+                if section.merge_ranges:
+                    merges = [
+                        (rango_merge, ("POST", f"{base}/workbook/worksheets/{ws_id}/range(address='{rango_merge}')/merge", (200, 204), {"across": True}))
+                        for rango_merge in _rangos_merge(section.merge_ranges, fila_inicio, num_filas)
+                    ]
             else:
-                self.llenar_seccion(file_key, section_key, datos)
+                # Campos de la sección en una sola fila: un PATCH de rango por sección
+                offset_inicio, valores, campos = _fila_campos(datos, columnas)
+                num_celdas = len(campos)
+                if campos:
+                    col_inicio = col_base + offset_inicio
+                    range_address = (
+                        f"{ws_name}!{_col_index_to_letters(col_inicio)}{fila_inicio}:"
+                        f"{_col_index_to_letters(col_inicio + len(valores) - 1)}{fila_inicio}"
+                    )
+                    llamadas.append((
+                        "PATCH", f"{base}/workbook/worksheets/{ws_id}/range(address='{range_address}')",
+                        (200,), {"values": [valores]}
+                    ))
+            
+            planes.append((section, section_key, datos, ws_name, num_celdas, desde, len(llamadas), merges))
+        
+        print(f"\n   Enviando {len(llamadas)} escrituras vía $batch...")
+        # Encadenadas con dependsOn: se aplican en el orden de las secciones, como antes, y sin
+        # ediciones concurrentes sobre el workbook (rangos que se pisan quedan como la última sección).
+        # Si una falla, las siguientes no se envían y quedan con error (424).
+        errores, _ = self.client.batch_requests(llamadas, sequential=True, workbook_session_id=sesion)
+        
+        # Los merges van después de los valores y solo para tablas escritas con éxito
+        merges = [m for *_, desde, hasta, ms in planes if ms and not any(errores[desde:hasta]) for m in ms]
+        if merges:
+            print(f"      Aplicando merges...")
+            errores_merge, _ = self.client.batch_requests([llamada for _, llamada in merges], workbook_session_id=sesion)
+            for (rango_merge, _), error in zip(merges, errores_merge):
+                if error is not None:
+                    print(f"      ⚠ No se pudo mergear {rango_merge}")
+        
+        duration = int((datetime.now() - start_time).total_seconds() * 1000)
+        tablas_con_error = []
+        for section, section_key, datos, ws_name, num_celdas, desde, hasta, _ in planes:
+            errores_seccion = [str(e) for e in errores[desde:hasta] if e is not None]
+            if section.is_table:
+                num_filas = len(datos)
+                if errores_seccion:
+                    tablas_con_error.append(section_key)
+                self._log_operation(
+                    op_type=OperationType.write_table,
+                    excel_file_id=excel_file.id,
+                    section_id=section.id,
+                    sheet_name=ws_name,
+                    rows_affected=None if errores_seccion else num_filas,
+                    cells_affected=None if errores_seccion else num_celdas,
+                    input_data={"section_key": section_key, "row_count": num_filas},
+                    status=RenderStatus.error if errores_seccion else RenderStatus.success,
+                    error_message=errores_seccion[0] if errores_seccion else None,
+                    duration_ms=duration
+                )
+            else:
+                self._log_operation(
+                    op_type=OperationType.write_section,
+                    excel_file_id=excel_file.id,
+                    section_id=section.id,
+                    sheet_name=ws_name,
+                    cells_affected=0 if errores_seccion else num_celdas,
+                    input_data={"section_key": section_key, "fields": list(datos.keys())},
+                    status=RenderStatus.success if not errores_seccion else RenderStatus.error,
+                    error_message=str(errores_seccion) if errores_seccion else None,
+                    duration_ms=duration
+                )
+        
+        if tablas_con_error:
+            raise Exception(f"No se pudieron escribir las tablas: {tablas_con_error}")
         
         print("\n✅ Completado")
     
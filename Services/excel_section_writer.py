@@ -7,27 +7,45 @@ Sistema SIMPLIFICADO de escritura en Excel con secciones dinámicas.
 2. llenar_seccion() - Llena una sección con datos
 3. guardar_excel() - Guarda el resultado
 """
-from io import BytesIO
-from typing import Dict, Any, List, Optional, Tuple
+import hashlib
+import queue
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from io import BufferedWriter, BytesIO, RawIOBase
+from typing import Dict, Any, BinaryIO, Iterator, List, Optional, Tuple, Union
+from zipfile import ZipFile, ZIP_DEFLATED
 from openpyxl import load_workbook
+from openpyxl.writer.excel import ExcelWriter
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.worksheet import Worksheet
 from openpyxl.cell.cell import MergedCell
 from copy import copy
 
 EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Nivel de DEFLATE al guardar; las partes XML comprimen bien aun en nivel 1 y es varias veces más rápido que el 6 por defecto
+XLSX_COMPRESS_LEVEL = 1
+# Tamaño de cada chunk al devolver el Excel en streaming y chunks máximos en vuelo entre hilos
+XLSX_STREAM_CHUNK_SIZE = 64 * 1024
+XLSX_STREAM_MAX_PENDING = 16
+
+# Posiciones de marcadores por template ya escaneado: (huella, markers) -> {marker: (fila, col)}
+_POSICIONES_CACHE: "OrderedDict[tuple, Dict[str, Tuple[int, int]]]" = OrderedDict()
+_POSICIONES_CACHE_LOCK = threading.Lock()
+_POSICIONES_CACHE_MAX = 64
 
 
 # ==========================================
 # FUNCIÓN 1: COPIAR TEMPLATE
 # ==========================================
 
-def copiar_template(template_bytes: bytes):
+def copiar_template(template_bytes: Union[bytes, BinaryIO]):
     """
     Copia el template Excel en memoria.
     
     Args:
-        template_bytes: Bytes del archivo Excel original
+        template_bytes: Bytes del archivo Excel original o un file-like seekable
     
     Returns:
         Workbook de openpyxl listo para editar
@@ -35,7 +53,7 @@ def copiar_template(template_bytes: bytes):
     Ejemplo:
         wb = copiar_template(template_bytes)
     """
-    return load_workbook(BytesIO(template_bytes))
+    return load_workbook(_abrir_template(template_bytes))
 
 
 # ==========================================
@@ -47,8 +65,9 @@ def llenar_seccion(
     marker: str,
     datos: Any,
     es_tabla: bool = False,
-    columnas: Dict[str, int] = None
-):
+    columnas: Dict[str, int] = None,
+    posicion: Optional[Tuple[int, int]] = None
+) -> Optional[Tuple[int, int]]:
     """
     Llena una sección del Excel buscando un marcador.
     
@@ -58,6 +77,10 @@ def llenar_seccion(
         datos: Dict para sección simple, List[Dict] para tabla
         es_tabla: True si es tabla (múltiples filas), False si es key-value simple
         columnas: Mapeo de campo -> offset de columna. Ej: {"fecha": 0, "monto": 1}
+        posicion: (fila, columna) del marcador si ya se conoce; evita recorrer la hoja
+    
+    Returns:
+        (fila_desde, cantidad) de las filas que insertó una tabla, o None si no insertó ninguna
     
     Ejemplos:
         # Sección simple (key-value)
@@ -90,14 +113,15 @@ def llenar_seccion(
         ws.protection.sheet = False
         print(f"   ⚠️  Hoja temporalmente desprotegida para edición")
     
-    # Buscar el marcador
-    marker_row, marker_col = _buscar_marcador(ws, marker)
+    # Buscar el marcador (salvo que ya venga ubicado)
+    marker_row, marker_col = posicion or _buscar_marcador(ws, marker)
     if not marker_row:
         raise ValueError(f"No se encontró '{marker}' en el Excel")
     
+    insercion = None
     if es_tabla:
         # Llenar tabla (múltiples filas)
-        _llenar_tabla(ws, marker_row, marker_col, datos, columnas)
+        insercion = _llenar_tabla(ws, marker_row, marker_col, datos, columnas)
     else:
         # Llenar valores simples (una sola fila)
         _llenar_valores(ws, marker_row, marker_col, datos, columnas)
@@ -106,6 +130,8 @@ def llenar_seccion(
     if estaba_protegida:
         ws.protection.sheet = True
         print(f"   🔒 Hoja protegida nuevamente")
+    
+    return insercion
 
 
 # ==========================================
@@ -127,15 +153,92 @@ def guardar_excel(wb) -> BytesIO:
         # Ahora puedes subirlo o guardarlo
     """
     output = BytesIO()
-    wb.save(output)
+    _escribir_xlsx(wb, output)
     output.seek(0)
     return output
 
 
+def guardar_excel_stream(wb) -> Iterator[bytes]:
+    """
+    Guarda el workbook entregando el .xlsx en chunks a medida que se comprime.
+    
+    El guardado corre en un hilo aparte y escribe a una cola acotada, así el primer
+    chunk sale sin esperar al archivo completo y la memoria queda limitada a unos
+    pocos chunks. Si el consumidor deja de leer (cliente desconectado), el hilo aborta.
+    
+    Ejemplo:
+        return Response(guardar_excel_stream(wb), mimetype=EXCEL_MIME)
+    """
+    cola: "queue.Queue" = queue.Queue(maxsize=XLSX_STREAM_MAX_PENDING)
+    cancelado = threading.Event()
+    fin = object()
+
+    def _guardar():
+        resultado = fin
+        try:
+            with BufferedWriter(_ColaWriter(cola, cancelado), XLSX_STREAM_CHUNK_SIZE) as destino:
+                _escribir_xlsx(wb, destino)
+        except Exception as e:
+            resultado = e
+        _encolar(cola, cancelado, resultado)
+
+    hilo = threading.Thread(target=_guardar, name="xlsx-stream", daemon=True)
+    hilo.start()
+    try:
+        while True:
+            chunk = cola.get()
+            if chunk is fin:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        cancelado.set()
+
+
 # ==========================================
 # FUNCIONES AUXILIARES (PRIVADAS)
 # ==========================================
 
+def _escribir_xlsx(wb, destino: BinaryIO):
+    """
+    Equivale a wb.save(destino), pero con un ZipFile propio para fijar el nivel de compresión.
+    Replica openpyxl.writer.excel.save_workbook de openpyxl 3.1 (ExcelWriter no es API pública):
+    revisarlo al cambiar de versión, que por eso está fijada en requirements.txt.
+    """
+    wb.properties.modified = datetime.now(timezone.utc).replace(tzinfo=None)
+    # ZipFile admite destinos no seekables (usa data descriptors), lo que permite el streaming
+    with ZipFile(destino, "w", ZIP_DEFLATED, allowZip64=True, compresslevel=XLSX_COMPRESS_LEVEL) as archive:
+        ExcelWriter(wb, archive).save()
+
+
+def _encolar(cola: "queue.Queue", cancelado: threading.Event, item) -> bool:
+    """Encola sin bloquear para siempre si el consumidor ya se fue."""
+    while not cancelado.is_set():
+        try:
+            cola.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class _ColaWriter(RawIOBase):
+    """Destino de escritura no seekable que pasa cada bloque a una cola."""
+
+    def __init__(self, cola: "queue.Queue", cancelado: threading.Event):
+        self._cola = cola
+        self._cancelado = cancelado
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if not _encolar(self._cola, self._cancelado, bytes(b)):
+            raise OSError("Descarga cancelada por el cliente")
+        return len(b)
+
+
 def _buscar_marcador(ws: Worksheet, marker: str) -> Tuple[Optional[int], Optional[int]]:
     """Busca el marcador en el Excel y retorna (fila, columna)."""
     for row in ws.iter_rows():
@@ -146,6 +249,83 @@ def _buscar_marcador(ws: Worksheet, marker: str) -> Tuple[Optional[int], Optiona
     return (None, None)
 
 
+def _abrir_template(template: Union[bytes, BinaryIO]) -> BinaryIO:
+    """Devuelve un file-like al inicio del template; los file-like se usan tal cual, sin copiarlos."""
+    if isinstance(template, (bytes, bytearray, memoryview)):
+        return BytesIO(template)
+    template.seek(0)
+    return template
+
+
+def _huella_template(template: Union[bytes, BinaryIO]) -> bytes:
+    """Hash del contenido del template; los file-like se leen por bloques y se rebobinan."""
+    if isinstance(template, (bytes, bytearray, memoryview)):
+        return hashlib.blake2b(template, digest_size=16).digest()
+    huella = hashlib.blake2b(digest_size=16)
+    template.seek(0)
+    for bloque in iter(lambda: template.read(1024 * 1024), b""):
+        huella.update(bloque)
+    template.seek(0)
+    return huella.digest()
+
+
+def _ubicar_marcadores_cache(template_bytes: Union[bytes, BinaryIO], markers) -> Dict[str, Tuple[int, int]]:
+    """Como _ubicar_marcadores, pero reutiliza el resultado si el mismo template ya se escaneó."""
+    key = (_huella_template(template_bytes), frozenset(markers))
+    with _POSICIONES_CACHE_LOCK:
+        posiciones = _POSICIONES_CACHE.get(key)
+        if posiciones is not None:
+            _POSICIONES_CACHE.move_to_end(key)
+            return posiciones
+
+    posiciones = _ubicar_marcadores(template_bytes, key[1])
+    with _POSICIONES_CACHE_LOCK:
+        _POSICIONES_CACHE[key] = posiciones
+        _POSICIONES_CACHE.move_to_end(key)
+        while len(_POSICIONES_CACHE) > _POSICIONES_CACHE_MAX:
+            _POSICIONES_CACHE.popitem(last=False)
+    return posiciones
+
+
+def _ubicar_marcadores(template_bytes: Union[bytes, BinaryIO], markers) -> Dict[str, Tuple[int, int]]:
+    """
+    Ubica todos los marcadores de la hoja activa en una sola pasada de solo lectura.
+
+    El modo read_only recorre el XML en streaming sin crear objetos Cell, a diferencia
+    de iter_rows() sobre el workbook editable, que materializa cada celda vacía.
+    """
+    pendientes = set(markers)
+    posiciones: Dict[str, Tuple[int, int]] = {}
+    if not pendientes:
+        return posiciones
+
+    wb_lectura = load_workbook(_abrir_template(template_bytes), read_only=True, keep_links=False)
+    try:
+        ws = wb_lectura.active
+        # La dimensión declarada en el XML puede estar mal; se recorre la hoja completa
+        ws.reset_dimensions()
+        # Prefiltro: una sola búsqueda (en C) por fila sobre sus valores unidos por un separador
+        # que ningún marcador contiene; solo las filas con coincidencia se revisan celda por celda
+        prefiltro = re.compile("|".join(re.escape(m) for m in pendientes))
+        for fila, valores in enumerate(ws.iter_rows(min_row=1, min_col=1, values_only=True), start=1):
+            linea = "\x00".join(str(valor) for valor in valores if valor)
+            if not prefiltro.search(linea):
+                continue
+            for col, valor in enumerate(valores, start=1):
+                if not valor:
+                    continue
+                texto = str(valor)
+                for marker in [m for m in pendientes if m in texto]:
+                    posiciones[marker] = (fila, col)
+                    pendientes.discard(marker)
+                    print(f"   ✓ Marcador '{marker}' encontrado en fila {fila}, columna {col}")
+            if not pendientes:
+                break
+    finally:
+        wb_lectura.close()
+    return posiciones
+
+
 def _escribir_en_celda(ws: Worksheet, fila: int, col: int, valor: Any):
     """Escribe en una celda, descombinándola si es necesario."""
     celda = ws.cell(fila, col)
@@ -189,14 +369,20 @@ def _llenar_valores(ws: Worksheet, marker_row: int, marker_col: int, datos: Dict
         _escribir_en_celda(ws, fila_destino, col_destino, valor)
 
 
-def _llenar_tabla(ws: Worksheet, marker_row: int, marker_col: int, filas: List[Dict], columnas: Dict):
-    """Llena tabla (múltiples filas) después del marcador."""
+def _llenar_tabla(ws: Worksheet, marker_row: int, marker_col: int, filas: List[Dict], columnas: Dict) -> Optional[Tuple[int, int]]:
+    """Llena tabla (múltiples filas) después del marcador; devuelve (fila_desde, cantidad) insertadas o None."""
     fila_inicio = marker_row + 2  # Saltar marcador + header
     
     # Insertar filas adicionales si es necesario
     num_filas_necesarias = len(filas)
+    insercion = None
     if num_filas_necesarias > 1:
-        ws.insert_rows(fila_inicio + 1, num_filas_necesarias - 1)
+        insercion = (fila_inicio + 1, num_filas_necesarias - 1)
+        ws.insert_rows(*insercion)
+    
+    # Columna destino por campo y formato de la fila template: se calculan una vez por tabla
+    col_por_campo = {campo: marker_col + col_offset for campo, col_offset in columnas.items()}
+    estilos_template = _estilos_fila(ws, fila_inicio) if num_filas_necesarias > 1 else []
     
     # Llenar cada fila
     for idx, fila_datos in enumerate(filas):
@@ -204,31 +390,38 @@ def _llenar_tabla(ws: Worksheet, marker_row: int, marker_col: int, filas: List[D
         
         # Copiar formato de la fila template
         if idx > 0:
-            _copiar_formato_fila(ws, fila_inicio, fila_actual)
+            _aplicar_estilos_fila(ws, fila_actual, estilos_template)
         
         # Escribir datos
         for campo, valor in fila_datos.items():
-            if campo not in columnas:
+            col_destino = col_por_campo.get(campo)
+            if col_destino is None:
                 continue
             
-            col_offset = columnas[campo]
-            col_destino = marker_col + col_offset
-            
             # Escribir en la celda (descombinándola si es necesario)
             _escribir_en_celda(ws, fila_actual, col_destino, valor)
+    
+    return insercion
 
 
-def _copiar_formato_fila(ws: Worksheet, fila_origen: int, fila_destino: int):
-    """Copia el formato de una fila a otra."""
+def _estilos_fila(ws: Worksheet, fila: int) -> List[Tuple[int, tuple]]:
+    """Copia una sola vez el formato (font, border, fill, alignment) de las celdas con estilo de una fila."""
+    estilos = []
     for col in range(1, ws.max_column + 1):
-        celda_origen = ws.cell(fila_origen, col)
-        celda_destino = ws.cell(fila_destino, col)
-        
-        if celda_origen.has_style:
-            celda_destino.font = copy(celda_origen.font)
-            celda_destino.border = copy(celda_origen.border)
-            celda_destino.fill = copy(celda_origen.fill)
-            celda_destino.alignment = copy(celda_origen.alignment)
+        celda = ws.cell(fila, col)
+        if celda.has_style:
+            estilos.append((col, (copy(celda.font), copy(celda.border), copy(celda.fill), copy(celda.alignment))))
+    return estilos
+
+
+def _aplicar_estilos_fila(ws: Worksheet, fila: int, estilos: List[Tuple[int, tuple]]):
+    """Aplica a una fila el formato obtenido con _estilos_fila."""
+    for col, (font, border, fill, alignment) in estilos:
+        celda_destino = ws.cell(fila, col)
+        celda_destino.font = font
+        celda_destino.border = border
+        celda_destino.fill = fill
+        celda_destino.alignment = alignment
 
 
 # ==========================================
@@ -236,20 +429,22 @@ def _copiar_formato_fila(ws: Worksheet, fila_origen: int, fila_destino: int):
 # ==========================================
 
 def procesar_excel_completo(
-    template_bytes: bytes,
+    template_bytes: Union[bytes, BinaryIO],
     secciones: Dict[str, Any],
-    configuracion: Dict[str, Dict]
-) -> BytesIO:
+    configuracion: Dict[str, Dict],
+    stream: bool = False
+) -> Union[BytesIO, Iterator[bytes]]:
     """
     Función todo-en-uno que procesa todas las secciones de un Excel.
     
     Args:
-        template_bytes: Bytes del template
+        template_bytes: Bytes del template o un file-like seekable (p. ej. el stream de un upload)
         secciones: Datos a escribir por sección
         configuracion: Config de cada sección (marker, columnas, es_tabla)
+        stream: True para recibir el .xlsx en chunks (ver guardar_excel_stream)
     
     Returns:
-        BytesIO con el Excel procesado
+        BytesIO con el Excel procesado, o un iterador de chunks si stream=True
     
     Ejemplo:
         output = procesar_excel_completo(
@@ -275,8 +470,14 @@ def procesar_excel_completo(
             }
         )
     """
-    # 1. Copiar template
+    # 1. Ubicar todos los marcadores en una sola pasada y copiar template
+    posiciones = _ubicar_marcadores_cache(
+        template_bytes,
+        {configuracion[nombre]["marker"] for nombre in secciones if nombre in configuracion}
+    )
     wb = copiar_template(template_bytes)
+    # Filas insertadas por tablas ya llenadas: (fila_desde, cantidad), en orden de aplicación
+    inserciones: List[Tuple[int, int]] = []
     
     # 2. Llenar cada sección
     for nombre_seccion, datos in secciones.items():
@@ -284,13 +485,39 @@ def procesar_excel_completo(
             continue
         
         config = configuracion[nombre_seccion]
-        llenar_seccion(
+        es_tabla = config.get("es_tabla", False)
+        posicion = posiciones.get(config["marker"])
+        if posicion:
+            fila, col = posicion
+            for desde, cantidad in inserciones:
+                if fila >= desde:
+                    fila += cantidad
+            posicion = (fila, col)
+        
+        insercion = llenar_seccion(
             wb,
             marker=config["marker"],
             datos=datos,
-            es_tabla=config.get("es_tabla", False),
-            columnas=config.get("columnas", {})
+            es_tabla=es_tabla,
+            columnas=config.get("columnas", {}),
+            posicion=posicion
         )
+        if insercion:
+            inserciones.append(insercion)
     
-    # 3. Guardar
+    # 3. Guardar (las secciones ya se llenaron; solo la serialización va en streaming)
+    if stream:
+        return guardar_excel_stream(wb)
     return guardar_excel(wb)
+
+
+def procesar_excel_bytes(
+    template_bytes: bytes,
+    secciones: Dict[str, Any],
+    configuracion: Dict[str, Dict]
+) -> bytes:
+    """
+    Igual que procesar_excel_completo pero recibe y devuelve bytes, para poder
+    ejecutarse en otro proceso (ProcessPoolExecutor) sin depender de objetos no picklables.
+    """
+    return procesar_excel_completo(template_bytes, secciones, configuracion).getvalue()
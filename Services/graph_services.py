@@ -1,8 +1,14 @@
+import gzip
+import os
 import time
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, Tuple, List
+import orjson
 import requests
 from requests import exceptions as requests_exceptions
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
 from Services.excel_render import fill_cells_in_memory, EXCEL_MIME
 
@@ -12,6 +18,28 @@ from Services.excel_render import fill_cells_in_memory, EXCEL_MIME
 _CELL_RE = re.compile(r"^(?:([^!]+)!)?([A-Za-z]+[1-9][0-9]*)$")  # [sheet!]ColRow
 _COL_LETTERS_RE = re.compile(r"^[A-Za-z]+$")
 
+# Pool compartido para repartir llamadas por celda (lectura/escritura) entre hilos.
+# El semáforo limita las peticiones simultáneas a Graph (~20 concurrentes por app antes de 429).
+_IO_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="graph-io")
+_GRAPH_CONCURRENCY = threading.BoundedSemaphore(20)
+# Máximo de sub-requests que Graph acepta por llamada a /$batch
+GRAPH_BATCH_LIMIT = 20
+_RETRYABLE_STATUSES = (423, 429, 502, 503, 504)
+# Cuerpos JSON de al menos este tamaño se envían con Content-Encoding: gzip (0 = desactivado)
+_GZIP_MIN_BYTES = int(os.getenv("GRAPH_GZIP_MIN_BYTES", 0))
+
+
+def _build_session() -> requests.Session:
+    """Session HTTP con pool de conexiones keep-alive hacia Graph."""
+    # Sin reintentos en el adapter: los status 429/503/... los maneja _request_with_retry (con Retry-After)
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=100))
+    return session
+
+
+# Una sola session por proceso: reutiliza conexiones TCP/TLS entre requests e instancias
+_SHARED_SESSION = _build_session()
+
 
 def _col_letters_to_index(letters: str) -> int:
     """Convert column letters (e.g., 'A', 'AA') to 1-based index."""
@@ -52,10 +80,22 @@ class GraphAPIError(Exception):
 # Core Graph client with retry
 # -----------------------------
 class GraphServices:
-    def __init__(self, access_token: str, correlation_id: Optional[str] = None, graph_url: str = "https://graph.microsoft.com/v1.0"):
+    def __init__(self, access_token: str, correlation_id: Optional[str] = None, graph_url: str = "https://graph.microsoft.com/v1.0", session: Optional[requests.Session] = None):
         self.access_token = access_token
         self.graph_url = graph_url
         self.correlation_id = correlation_id  # our own request-id for logs/propagation
+        self.session = session or _SHARED_SESSION
+
+    def close(self) -> None:
+        """Libera las conexiones de la session propia; la compartida del proceso no se cierra."""
+        if self.session is not _SHARED_SESSION:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def _headers(self, content_type: str = "application/json") -> Dict[str, str]:
         h = {
@@ -80,12 +120,21 @@ class GraphServices:
         hdrs = headers or self._headers()
         last_ms_req_id = None
 
+        # Se serializa y comprime una sola vez, fuera del loop de reintentos
+        if _GZIP_MIN_BYTES and kwargs.get("json") is not None:
+            payload = orjson.dumps(kwargs.pop("json"))
+            if len(payload) >= _GZIP_MIN_BYTES:
+                payload = gzip.compress(payload, compresslevel=1)
+                hdrs = {**hdrs, "Content-Encoding": "gzip"}
+            kwargs["data"] = payload
+
         resp: Optional[requests.Response] = None
         last_exception: Optional[requests_exceptions.RequestException] = None
 
         for attempt in range(1, max_attempts + 1):
             try:
-                resp = requests.request(method, url, headers=hdrs, timeout=60, **kwargs)
+                with _GRAPH_CONCURRENCY:
+                    resp = self.session.request(method, url, headers=hdrs, timeout=60, **kwargs)
                 last_exception = None
             except requests_exceptions.RequestException as exc:
                 last_exception = exc
@@ -98,7 +147,7 @@ class GraphServices:
                 return resp, last_ms_req_id
 
             # Retryable statuses
-            if resp.status_code in (423, 429, 502, 503, 504):
+            if resp.status_code in _RETRYABLE_STATUSES:
                 # Honoring Retry-After if provided
                 ra = resp.headers.get("Retry-After")
                 if ra:
@@ -135,6 +184,96 @@ class GraphServices:
             ) from last_exception
         raise GraphAPIError(status_code=500, message="Max retries exceeded", ms_request_id=last_ms_req_id)
 
+    def batch_requests(self, calls: List[Tuple[str, str, Tuple[int, ...], Any]], *, sequential: bool = False, workbook_session_id: Optional[str] = None) -> Tuple[List[Optional[Exception]], Dict[str, Optional[str]]]:
+        """
+        Envía las llamadas (method, url, expected, json) vía /$batch, de a GRAPH_BATCH_LIMIT por POST.
+        Los lotes van en orden; dentro de un lote Graph no garantiza orden salvo con sequential=True,
+        que encadena cada sub-request a la anterior con dependsOn.
+        Las sub-requests con status reintentable se reenvían (hasta 3 rondas)
+        (en modo secuencial también las que fallaron por dependencia, 424).
+        En modo secuencial, si un lote termina con algún error, los lotes siguientes no se
+        envían y sus llamadas quedan con un GraphAPIError 424 (como dependsOn dentro del lote).
+        Con workbook_session_id, cada sub-request va dentro de esa sesión de workbook.
+        Devuelve (errores, ms_ids): errores en el orden de entrada (None solo si volvió con un status esperado).
+        """
+        errors: List[Optional[Exception]] = [None] * len(calls)
+        ms_ids: Dict[str, Optional[str]] = {}
+        batch_url = f"{self.graph_url}/$batch"
+
+        for start in range(0, len(calls), GRAPH_BATCH_LIMIT):
+            end = min(start + GRAPH_BATCH_LIMIT, len(calls))
+            pending = list(range(start, end))
+            for attempt in range(1, 4):
+                # Una sub-request que no vuelve en "responses" (cuerpo truncado o inesperado) no es un éxito
+                for idx in pending:
+                    errors[idx] = GraphAPIError(status_code=0, message=f"Sub-request {idx} sin respuesta en $batch")
+                sub_requests = []
+                for pos, idx in enumerate(pending):
+                    method, url, _, body = calls[idx]
+                    sub = {"id": str(idx), "method": method, "url": url[len(self.graph_url):] if url.startswith(self.graph_url) else url}
+                    if body is not None:
+                        sub["body"] = body
+                        sub["headers"] = {"Content-Type": "application/json"}
+                    if workbook_session_id:
+                        sub.setdefault("headers", {})["workbook-session-id"] = workbook_session_id
+                    if sequential and pos:
+                        sub["dependsOn"] = [str(pending[pos - 1])]
+                    sub_requests.append(sub)
+
+                resp, ms_batch_id = self._request_with_retry("POST", batch_url, expected=(200,), headers=self._headers(), json={"requests": sub_requests})
+                ms_ids[f"batch_{start}_{attempt}"] = ms_batch_id
+
+                retry, failed_dependency, retry_after = [], [], 0.0
+                for sub_resp in (resp.json() or {}).get("responses", []):
+                    idx = int(sub_resp.get("id"))
+                    status = sub_resp.get("status")
+                    if status in calls[idx][2]:
+                        errors[idx] = None
+                        continue
+                    body = sub_resp.get("body") or {}
+                    message = (body.get("error") or {}).get("message") if isinstance(body, dict) else None
+                    errors[idx] = GraphAPIError(
+                        status_code=status or 0,
+                        message=message or f"Sub-request {idx} falló en $batch",
+                        ms_request_id=(sub_resp.get("headers") or {}).get("request-id"),
+                    )
+                    if sequential and status == 424:
+                        failed_dependency.append(idx)
+                    elif status in _RETRYABLE_STATUSES:
+                        retry.append(idx)
+                        try:
+                            retry_after = max(retry_after, float((sub_resp.get("headers") or {}).get("Retry-After") or 0))
+                        except ValueError:
+                            pass
+                if not retry:
+                    break
+                pending = sorted(retry + failed_dependency)
+                time.sleep(retry_after or 0.6 * attempt)
+
+            # dependsOn no cruza lotes: la cadena se corta aquí explícitamente
+            if sequential and any(errors[start:end]):
+                for idx in range(end, len(calls)):
+                    errors[idx] = GraphAPIError(
+                        status_code=424,
+                        message=f"Sub-request {idx} no enviada: falló una anterior de la cadena secuencial",
+                    )
+                break
+
+        return errors, ms_ids
+
+    def create_workbook_session(self, item_url: str, persist_changes: bool = True) -> str:
+        """Abre una sesión de workbook sobre item_url (.../items/{id}) y devuelve su id."""
+        resp, _ = self._request_with_retry(
+            "POST", f"{item_url}/workbook/createSession", expected=(200, 201),
+            headers=self._headers(), json={"persistChanges": persist_changes}
+        )
+        return resp.json()["id"]
+
+    def close_workbook_session(self, item_url: str, session_id: str) -> None:
+        """Cierra una sesión de workbook abierta con create_workbook_session."""
+        hdrs = {**self._headers(), "workbook-session-id": session_id}
+        self._request_with_retry("POST", f"{item_url}/workbook/closeSession", expected=(200, 204), headers=hdrs)
+
     # ---------- high-level helpers ----------
     def download_file_bytes(self, full_path: str, target_user_id: str = None, drive_id: str = None) -> Tuple[bytes, Optional[str]]:
         full_path_enc = "/".join(quote(p) for p in full_path.split("/"))
@@ -176,6 +315,18 @@ class GraphServices:
         resp, ms_id = self._request_with_retry("GET", url, expected=(200,), headers=self._headers())
         return resp.json()["id"], ms_id
 
+    def get_item_metadata(self, full_path: str, *, target_user_id: str = None, drive_id: str = None) -> Tuple[dict, Optional[str]]:
+        """Metadatos ligeros (id, eTag, cTag) de un archivo sin descargar su contenido."""
+        full_path_enc = "/".join(quote(p) for p in full_path.split("/"))
+        if drive_id:
+            url = f"{self.graph_url}/drives/{drive_id}/root:/{full_path_enc}?$select=id,eTag,cTag"
+        elif target_user_id:
+            url = f"{self.graph_url}/users/{target_user_id}/drive/root:/{full_path_enc}?$select=id,eTag,cTag"
+        else:
+            raise ValueError("Debes pasar target_user_id o drive_id")
+        resp, ms_id = self._request_with_retry("GET", url, expected=(200,), headers=self._headers())
+        return resp.json(), ms_id
+
     def _resolve_worksheets(self, *, item_id: str, target_user_id: str = None, drive_id: str = None) -> Tuple[list[dict], Optional[str]]:
         if drive_id:
             url = f"{self.graph_url}/drives/{drive_id}/items/{item_id}/workbook/worksheets?$select=id,name"
@@ -197,6 +348,12 @@ class GraphServices:
         ms_ids_accum = {"resolve_item": ms_resolve_id, "list_sheets": ms_ws_id}
         results = {}
 
+        if drive_id:
+            base = f"{self.graph_url}/drives/{drive_id}/items/{item_id}"
+        else:
+            base = f"{self.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+
+        pending = {}
         for key, value in data.items():
             m = _CELL_RE.match(key)
             if not m:
@@ -217,39 +374,41 @@ class GraphServices:
                 }
                 continue
 
-            if drive_id:
-                base = f"{self.graph_url}/drives/{drive_id}/items/{item_id}"
-            else:
-                base = f"{self.graph_url}/users/{target_user_id}/drive/items/{item_id}"
-
             url = f"{base}/workbook/worksheets/{ws_id}/range(address='{addr}')"
-            try:
-                resp, ms_patch_id = self._request_with_retry(
-                    "PATCH",
-                    url,
-                    expected=(200,),
-                    headers=self._headers(),
-                    json={"values": [[value]]},
-                )
+            results[key] = None  # conserva el orden de entrada
+            pending[key] = _IO_POOL.submit(self._write_one_cell, url, value)
+
+        for key, future in pending.items():
+            results[key], ms_patch_id = future.result()
+            if results[key].get("status") == "ok" or "ms_request_id" in results[key]:
                 ms_ids_accum[f"patch_{key}"] = ms_patch_id
-                results[key] = {"status": "ok"}
-            except GraphAPIError as ge:
-                ms_ids_accum[f"patch_{key}"] = ge.ms_request_id
-                results[key] = {
-                    "status": "error",
-                    "message": ge.message,
-                    "http_status": ge.status_code,
-                    "ms_request_id": ge.ms_request_id,
-                }
-            except Exception as err:
-                results[key] = {
-                    "status": "error",
-                    "message": str(err),
-                    "http_status": None,
-                }
 
         return {"written": results}, ms_ids_accum
 
+    def _write_one_cell(self, url: str, value: Any) -> Tuple[Dict[str, Any], Optional[str]]:
+        try:
+            _, ms_patch_id = self._request_with_retry(
+                "PATCH",
+                url,
+                expected=(200,),
+                headers=self._headers(),
+                json={"values": [[value]]},
+            )
+            return {"status": "ok"}, ms_patch_id
+        except GraphAPIError as ge:
+            return {
+                "status": "error",
+                "message": ge.message,
+                "http_status": ge.status_code,
+                "ms_request_id": ge.ms_request_id,
+            }, ge.ms_request_id
+        except Exception as err:
+            return {
+                "status": "error",
+                "message": str(err),
+                "http_status": None,
+            }, None
+
     # ---------- in-memory Excel render ----------
     def render_in_memory(self, template_bytes: bytes, data: dict) -> bytes:
         out = fill_cells_in_memory(template_bytes, data)
@@ -270,6 +429,12 @@ class GraphServices:
         ms_ids_accum: Dict[str, Optional[str]] = {"resolve_item": ms_resolve_id, "list_sheets": ms_ws_id}
         results: Dict[str, Dict[str, Any]] = {}
 
+        if drive_id:
+            base = f"{self.graph_url}/drives/{drive_id}/items/{item_id}"
+        else:
+            base = f"{self.graph_url}/users/{target_user_id}/drive/items/{item_id}"
+
+        pending = {}
         for cell in cells:
             m = _CELL_RE.match(cell)
             if not m:
@@ -290,46 +455,48 @@ class GraphServices:
                 }
                 continue
 
-            if drive_id:
-                base = f"{self.graph_url}/drives/{drive_id}/items/{item_id}"
-            else:
-                base = f"{self.graph_url}/users/{target_user_id}/drive/items/{item_id}"
-
             url = f"{base}/workbook/worksheets/{ws_id}/range(address='{addr}')"
-            try:
-                resp, ms_get_id = self._request_with_retry(
-                    "GET",
-                    url,
-                    expected=(200,),
-                    headers=self._headers(),
-                )
+            results[cell] = None  # conserva el orden de entrada
+            pending[cell] = _IO_POOL.submit(self._read_one_cell, url)
+
+        for cell, future in pending.items():
+            results[cell], ms_get_id = future.result()
+            if results[cell].get("status") == "ok" or "ms_request_id" in results[cell]:
                 ms_ids_accum[f"get_{cell}"] = ms_get_id
-                payload = resp.json()
-                values = payload.get("values", [])
-                value = None
-                if isinstance(values, list) and values:
-                    first_row = values[0]
-                    if isinstance(first_row, list) and first_row:
-                        value = first_row[0]
-
-                results[cell] = {"status": "ok", "value": value}
-            except GraphAPIError as ge:
-                ms_ids_accum[f"get_{cell}"] = ge.ms_request_id
-                results[cell] = {
-                    "status": "error",
-                    "message": ge.message,
-                    "http_status": ge.status_code,
-                    "ms_request_id": ge.ms_request_id,
-                }
-            except Exception as err:
-                results[cell] = {
-                    "status": "error",
-                    "message": str(err),
-                    "http_status": None,
-                }
 
         return {"cells": results}, ms_ids_accum
 
+    def _read_one_cell(self, url: str) -> Tuple[Dict[str, Any], Optional[str]]:
+        try:
+            resp, ms_get_id = self._request_with_retry(
+                "GET",
+                url,
+                expected=(200,),
+                headers=self._headers(),
+            )
+            payload = resp.json()
+            values = payload.get("values", [])
+            value = None
+            if isinstance(values, list) and values:
+                first_row = values[0]
+                if isinstance(first_row, list) and first_row:
+                    value = first_row[0]
+
+            return {"status": "ok", "value": value}, ms_get_id
+        except GraphAPIError as ge:
+            return {
+                "status": "error",
+                "message": ge.message,
+                "http_status": ge.status_code,
+                "ms_request_id": ge.ms_request_id,
+            }, ge.ms_request_id
+        except Exception as err:
+            return {
+                "status": "error",
+                "message": str(err),
+                "http_status": None,
+            }, None
+
     def insert_rows_graph(
         self,
         *,
@@ -1,8 +1,10 @@
 import logging
 import os
 import sys
+import orjson
 from dotenv import load_dotenv
 from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
@@ -10,6 +12,19 @@ from routes.routes import graph_bp
 from routes.routes2 import bp as excel_bp
 from Postgress.connection import init_db, SessionLocal
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider de Flask respaldado por orjson (jsonify y request.get_json)."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 class GraphAPIApp:
     def __init__(self):
         load_dotenv()
@@ -26,6 +41,7 @@ class GraphAPIApp:
     def create_app(self):
         app = Flask(__name__)
         app.secret_key = os.environ.get("FLASK_SECRET_KEY")
+        app.json = OrjsonProvider(app)
 
         # Inicializar DB
         init_db()
@@ -1,9 +1,18 @@
 # routes/routes.py
+import logging
+import re
+import threading
 import time
 import json
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 from typing import Optional, Tuple
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, g, request, jsonify
+from sqlalchemy import and_, false, select
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
 from Postgress.Tables import (
     TenantCredentials,
     TenantUsers,
@@ -27,15 +36,33 @@ from validators.payload import (
     build_dest_file_name,
     new_correlation_id,
     require_fields,
-    validate_cell_map_or_raise,
-    validate_data_dict,
+    validate_cell_list,
+    validate_data_and_cells,
     validate_location_selector,
     validate_naming_dict,
     validate_section_data,
     validate_string_field,
+    validate_string_fields,
 )
 
 graph_bp = Blueprint("graph", __name__)
+logger = logging.getLogger(__name__)
+
+# Palabras clave que delatan un marcador de sección en find-markers
+MARKER_KEYWORDS = frozenset([
+    'DATOS', 'DETALLE', 'TOTAL', 'RESUMEN', 'CLIENTE',
+    'PAGOS', 'ITEMS', 'PRODUCTOS', 'SERVICIOS', 'FOOTER',
+    'HEADER', 'INFORMACIÓN',
+])
+# Una sola pasada por celda en lugar de buscar cada palabra clave por separado
+MARKER_RE = re.compile("|".join(re.escape(keyword) for keyword in sorted(MARKER_KEYWORDS)), re.IGNORECASE)
+# Tipos JSON escalares admitidos como valores de celda en insert-rows
+_ROW_VALUE_TYPES = frozenset({str, int, float, bool, type(None)})
+
+# Marcadores por template ya escaneados: key -> (eTag, markers). LRU acotado por proceso.
+_MARKERS_CACHE: "OrderedDict[tuple, Tuple[str, list]]" = OrderedDict()
+_MARKERS_CACHE_LOCK = threading.Lock()
+_MARKERS_CACHE_MAX = 256
 
 # ------------------ Helpers ------------------ #
 def _join_storage_path(*segments: str) -> str:
@@ -58,13 +85,174 @@ def _resolve_graph_target(storage) -> Tuple[Optional[str], Optional[str]]:
         return None, None
 
     location_type = getattr(storage, "location_type", None)
-    location_identifier = getattr(storage, "location_identifier", None)
+    # La columna es un Enum (LocationType); se normaliza a su valor string
+    location_type = getattr(location_type, "value", location_type)
+    return _graph_target_for(
+        location_type,
+        getattr(storage, "location_identifier", None),
+        getattr(storage, "target_user_id", None),
+    )
+
+
+@lru_cache(maxsize=1024)
+def _graph_target_for(location_type, location_identifier, legacy_target_user_id) -> Tuple[Optional[str], Optional[str]]:
     if location_type in {"drive", "user"} and location_identifier:
         if location_type == "drive":
             return location_identifier, None
         return None, location_identifier
 
-    return None, getattr(storage, "target_user_id", None)
+    return None, legacy_target_user_id
+
+
+@lru_cache(maxsize=4096)
+def _validate_dest_file_name(name: str) -> Tuple[Optional[str], str]:
+    """Devuelve (error, nombre_limpio); se memoiza porque los nombres se repiten entre requests."""
+    cleaned = name.strip()
+    if any(sep in cleaned for sep in ("/", "\\")) or cleaned.startswith(".") or ".." in cleaned:
+        return "dest_file_name inválido", cleaned
+    if not cleaned.lower().endswith(".xlsx"):
+        return "dest_file_name debe terminar en .xlsx", cleaned
+    return None, cleaned
+
+
+def _validate_target_alias(alias) -> Tuple[Optional[str], Optional[str]]:
+    """Devuelve (error, alias_limpio); un alias vacío tras el strip equivale a None."""
+    if not isinstance(alias, str):
+        return validate_string_field("target_alias", alias, max_length=MAX_TARGET_ALIAS_LENGTH), None
+    return _validate_target_alias_str(alias)
+
+
+@lru_cache(maxsize=4096)
+def _validate_target_alias_str(alias: str) -> Tuple[Optional[str], Optional[str]]:
+    err = validate_string_field("target_alias", alias, max_length=MAX_TARGET_ALIAS_LENGTH)
+    if err:
+        return err, None
+    alias_clean = alias.strip()
+    if alias_clean and not ALLOWED_IDENTIFIER_RE.match(alias_clean):
+        return "target_alias contiene caracteres no permitidos", None
+    return None, alias_clean or None
+
+
+def _scan_template_markers(tpl_bytes: bytes) -> list:
+    """Recorre todas las hojas del template y devuelve las celdas que parecen marcadores."""
+    from openpyxl import load_workbook
+    from openpyxl.utils import get_column_letter
+    from io import BytesIO
+
+    # read_only: openpyxl lee el XML en streaming sin construir el modelo completo de celdas
+    wb = load_workbook(BytesIO(tpl_bytes), read_only=True, data_only=True, keep_links=False)
+    markers = []
+    try:
+        for sheet in wb.worksheets:
+            # La dimensión declarada en el XML puede faltar o estar desactualizada y read_only
+            # recortaría iter_rows a ella; se recorre la hoja completa
+            sheet.reset_dimensions()
+            # values_only evita construir un objeto Cell por celda; fila/columna salen de la posición
+            for row_idx, row in enumerate(sheet.iter_rows(min_row=1, min_col=1, values_only=True), start=1):
+                for col_idx, value in enumerate(row, start=1):
+                    if not value or not isinstance(value, str):
+                        continue
+                    text = value.strip()
+                    # Del chequeo más barato al más caro; len() es O(1) y evita isupper() en textos cortos
+                    is_marker = (
+                        text.endswith(':')
+                        or MARKER_RE.search(text) is not None
+                        or (len(text) > 3 and text.isupper())
+                    )
+
+                    if is_marker:
+                        col_letter = get_column_letter(col_idx)
+                        markers.append({
+                            "text": text,
+                            "position": f"{col_letter}{row_idx}",
+                            "sheet": sheet.title,
+                            "row": row_idx,
+                            "column": col_idx
+                        })
+    finally:
+        # En read_only el workbook mantiene abierto el archivo: se cierra aunque una hoja falle
+        wb.close()
+    return markers
+
+
+def _get_cached_markers(key: tuple, etag: Optional[str]) -> Optional[list]:
+    if not etag:
+        return None
+    with _MARKERS_CACHE_LOCK:
+        cached = _MARKERS_CACHE.get(key)
+        if cached is None or cached[0] != etag:
+            return None
+        _MARKERS_CACHE.move_to_end(key)
+        return cached[1]
+
+
+def _store_cached_markers(key: tuple, etag: str, markers: list) -> None:
+    with _MARKERS_CACHE_LOCK:
+        _MARKERS_CACHE[key] = (etag, markers)
+        _MARKERS_CACHE.move_to_end(key)
+        while len(_MARKERS_CACHE) > _MARKERS_CACHE_MAX:
+            _MARKERS_CACHE.popitem(last=False)
+
+
+def _resolve_tenant_storage(
+    db,
+    client_key: str,
+    *,
+    target_alias: Optional[str] = None,
+    location_type: Optional[str] = None,
+    location_identifier: Optional[str] = None,
+    template_key: Optional[str] = None,
+):
+    """
+    Resuelve (creds, tenant_user, storage, template) en una sola consulta con JOINs.
+    Cada elemento no encontrado se devuelve como None; si creds es None el cliente
+    no existe o está deshabilitado.
+    """
+    storage_on = and_(
+        StorageTargets.client_key == TenantCredentials.client_key,
+        StorageTargets.tenant_id == TenantCredentials.id,
+    )
+    if target_alias:
+        user_on = and_(TenantUsers.tenant_id == TenantCredentials.id, TenantUsers.alias == target_alias)
+        storage_on = and_(storage_on, StorageTargets.tenant_user_id == TenantUsers.id)
+    else:
+        user_on = false()
+        if location_type and location_identifier:
+            storage_on = and_(
+                storage_on,
+                StorageTargets.location_type == location_type,
+                StorageTargets.location_identifier == location_identifier,
+            )
+
+    if template_key:
+        template_on = and_(Templates.client_key == TenantCredentials.client_key, Templates.template_key == template_key)
+    else:
+        template_on = false()
+
+    stmt = (
+        select(TenantCredentials, TenantUsers, StorageTargets, Templates)
+        .select_from(TenantCredentials)
+        .outerjoin(TenantUsers, user_on)
+        .outerjoin(StorageTargets, storage_on)
+        .outerjoin(Templates, template_on)
+        .where(TenantCredentials.client_key == client_key, TenantCredentials.enabled.is_(True))
+        .limit(1)
+    )
+    row = db.execute(stmt).first()
+    if row is None:
+        return None, None, None, None
+    return tuple(row)
+
+
+# ------------------ ERRORES ------------------ #
+
+@graph_bp.errorhandler(Exception)
+def _handle_unexpected_error(e):
+    """Errores no previstos por las rutas: se registran una vez y se responde 500 con correlation_id."""
+    if isinstance(e, HTTPException):
+        return e
+    logger.exception("Error no controlado en %s", request.path)
+    return jsonify({"error": str(e), "correlation_id": g.get("correlation_id")}), 500
 
 
 # ------------------ ROUTES ------------------ #
@@ -134,15 +322,11 @@ def render_upload():
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("client_key", body.get("client_key"), max_length=MAX_CLIENT_FIELD_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("template_key", body.get("template_key"), max_length=MAX_TEMPLATE_KEY_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("tenant_name", body.get("tenant_name"), max_length=MAX_TENANT_NAME_LENGTH)
+    err = validate_string_fields(body, (
+        ("client_key", MAX_CLIENT_FIELD_LENGTH),
+        ("template_key", MAX_TEMPLATE_KEY_LENGTH),
+        ("tenant_name", MAX_TENANT_NAME_LENGTH),
+    ))
     if err:
         return jsonify({"error": err}), 400
 
@@ -153,15 +337,10 @@ def render_upload():
             return jsonify({"error": err}), 400
     else:
         # Modo legacy
-        err = validate_data_dict(body.get("data"))
+        err = validate_data_and_cells(body.get("data"))
         if err:
             return jsonify({"error": err}), 400
 
-        try:
-            validate_cell_map_or_raise(body["data"])
-        except ValueError as ve:
-            return jsonify({"error": str(ve)}), 400
-
     naming_provided = body.get("naming") not in (None, {})
     naming_err, sanitized_naming = validate_naming_dict(body.get("naming"))
     if naming_err:
@@ -170,13 +349,10 @@ def render_upload():
 
     target_alias = body.get("target_alias")
     if target_alias is not None:
-        err = validate_string_field("target_alias", target_alias, max_length=MAX_TARGET_ALIAS_LENGTH)
+        err, alias_clean = _validate_target_alias(target_alias)
         if err:
             return jsonify({"error": err}), 400
-        alias_clean = target_alias.strip()
-        if alias_clean and not ALLOWED_IDENTIFIER_RE.match(alias_clean):
-            return jsonify({"error": "target_alias contiene caracteres no permitidos"}), 400
-        body["target_alias"] = alias_clean or None
+        body["target_alias"] = alias_clean
 
     loc_err, (normalized_type, ident_clean) = validate_location_selector(body.get("location_type"), body.get("location_identifier"))
     if loc_err:
@@ -194,50 +370,28 @@ def render_upload():
 
     try:
         # 1) Config del tenant
-        creds = (
-            db.query(TenantCredentials)
-            .filter_by(client_key=body["client_key"], enabled=True)
-            .first()
+        target_alias = body.get("target_alias")
+        location_type = body.get("location_type")
+        location_identifier = body.get("location_identifier")
+        creds, tenant_user, storage, template = _resolve_tenant_storage(
+            db,
+            body["client_key"],
+            target_alias=target_alias,
+            location_type=location_type,
+            location_identifier=location_identifier,
+            template_key=body["template_key"],
         )
         if not creds:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
-        storage_query = (
-            db.query(StorageTargets)
-            .filter_by(client_key=body["client_key"], tenant_id=creds.id)
-        )
-        target_alias = body.get("target_alias")
-        location_type = body.get("location_type")
-        location_identifier = body.get("location_identifier")
-        tenant_user = None
         if target_alias:
-            tenant_user = (
-                db.query(TenantUsers)
-                .filter_by(tenant_id=creds.id, alias=target_alias)
-                .first()
-            )
             if not tenant_user:
                 return jsonify({"error": f"target_alias '{target_alias}' no está configurado"}), 400
-            storage = storage_query.filter_by(tenant_user_id=tenant_user.id).first()
             if not storage:
                 return jsonify({"error": f"No hay destino configurado para el alias '{target_alias}'"}), 400
-        else:
-            if location_type and location_identifier:
-                storage = (
-                    storage_query
-                    .filter_by(location_type=location_type, location_identifier=location_identifier)
-                    .first()
-                )
-                if not storage:
-                    return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
-            else:
-                storage = storage_query.first()
+        elif location_type and location_identifier and not storage:
+            return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
 
-        template = (
-            db.query(Templates)
-            .filter_by(client_key=body["client_key"], template_key=body["template_key"])
-            .first()
-        )
         if not storage or not template:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
@@ -416,40 +570,29 @@ def write_cells():
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("client_key", body.get("client_key"), max_length=MAX_CLIENT_FIELD_LENGTH)
+    err = validate_string_fields(body, (
+        ("client_key", MAX_CLIENT_FIELD_LENGTH),
+        ("dest_file_name", MAX_DEST_FILE_NAME_LENGTH),
+    ))
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("dest_file_name", body.get("dest_file_name"), max_length=MAX_DEST_FILE_NAME_LENGTH)
+    # Validación de tipos, límites y direcciones en una sola pasada
+    err = validate_data_and_cells(body.get("data"))
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_data_dict(body.get("data"))
+    err, dest_file_name = _validate_dest_file_name(body["dest_file_name"])
     if err:
         return jsonify({"error": err}), 400
-
-    # Validación de direcciones y valores
-    try:
-        validate_cell_map_or_raise(body["data"])
-    except ValueError as ve:
-        return jsonify({"error": str(ve)}), 400
-
-    dest_file_name = body["dest_file_name"].strip()
-    if any(sep in dest_file_name for sep in ("/", "\\")) or dest_file_name.startswith(".") or ".." in dest_file_name:
-        return jsonify({"error": "dest_file_name inválido"}), 400
-    if not dest_file_name.lower().endswith(".xlsx"):
-        return jsonify({"error": "dest_file_name debe terminar en .xlsx"}), 400
     body["dest_file_name"] = dest_file_name
 
     target_alias = body.get("target_alias")
     if target_alias is not None:
-        err = validate_string_field("target_alias", target_alias, max_length=MAX_TARGET_ALIAS_LENGTH)
+        err, alias_clean = _validate_target_alias(target_alias)
         if err:
             return jsonify({"error": err}), 400
-        alias_clean = target_alias.strip()
-        if alias_clean and not ALLOWED_IDENTIFIER_RE.match(alias_clean):
-            return jsonify({"error": "target_alias contiene caracteres no permitidos"}), 400
-        body["target_alias"] = alias_clean or None
+        body["target_alias"] = alias_clean
 
     loc_err, (normalized_type, ident_clean) = validate_location_selector(
         body.get("location_type"), body.get("location_identifier")
@@ -465,44 +608,26 @@ def write_cells():
     db = request.environ.get("db_session")
 
     try:
-        creds = (
-            db.query(TenantCredentials)
-            .filter_by(client_key=body["client_key"], enabled=True)
-            .first()
+        target_alias = body.get("target_alias")
+        location_type = body.get("location_type")
+        location_identifier = body.get("location_identifier")
+        creds, tenant_user, storage, _ = _resolve_tenant_storage(
+            db,
+            body["client_key"],
+            target_alias=target_alias,
+            location_type=location_type,
+            location_identifier=location_identifier,
         )
         if not creds:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
-        storage_query = (
-            db.query(StorageTargets)
-            .filter_by(client_key=body["client_key"], tenant_id=creds.id)
-        )
-        target_alias = body.get("target_alias")
-        location_type = body.get("location_type")
-        location_identifier = body.get("location_identifier")
-        tenant_user = None
         if target_alias:
-            tenant_user = (
-                db.query(TenantUsers)
-                .filter_by(tenant_id=creds.id, alias=target_alias)
-                .first()
-            )
             if not tenant_user:
                 return jsonify({"error": f"target_alias '{target_alias}' no está configurado"}), 400
-            storage = storage_query.filter_by(tenant_user_id=tenant_user.id).first()
             if not storage:
                 return jsonify({"error": f"No hay destino configurado para el alias '{target_alias}'"}), 400
-        else:
-            if location_type and location_identifier:
-                storage = (
-                    storage_query
-                    .filter_by(location_type=location_type, location_identifier=location_identifier)
-                    .first()
-                )
-                if not storage:
-                    return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
-            else:
-                storage = storage_query.first()
+        elif location_type and location_identifier and not storage:
+            return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
 
         if not storage:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
@@ -635,15 +760,11 @@ def read_cells():
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("client_key", body.get("client_key"), max_length=MAX_CLIENT_FIELD_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("tenant_name", body.get("tenant_name"), max_length=MAX_TENANT_NAME_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("dest_file_name", body.get("dest_file_name"), max_length=MAX_DEST_FILE_NAME_LENGTH)
+    err = validate_string_fields(body, (
+        ("client_key", MAX_CLIENT_FIELD_LENGTH),
+        ("tenant_name", MAX_TENANT_NAME_LENGTH),
+        ("dest_file_name", MAX_DEST_FILE_NAME_LENGTH),
+    ))
     if err:
         return jsonify({"error": err}), 400
 
@@ -651,84 +772,52 @@ def read_cells():
     if not isinstance(expected_cells, dict):
         return jsonify({"error": "cell_mapping_fill debe ser un diccionario"}), 400
 
-    err = validate_data_dict(expected_cells)
+    err = validate_data_and_cells(expected_cells)
     if err:
         return jsonify({"error": err}), 400
 
-    try:
-        validate_cell_map_or_raise(expected_cells)
-    except ValueError as ve:
-        return jsonify({"error": str(ve)}), 400
-
-    dest_file_name = body["dest_file_name"].strip()
-    if any(sep in dest_file_name for sep in ("/", "\\")) or dest_file_name.startswith(".") or ".." in dest_file_name:
-        return jsonify({"error": "dest_file_name inválido"}), 400
-    if not dest_file_name.lower().endswith(".xlsx"):
-        return jsonify({"error": "dest_file_name debe terminar en .xlsx"}), 400
-    body["dest_file_name"] = dest_file_name
+    err, dest_file_name = _validate_dest_file_name(body["dest_file_name"])
+    if err:
+        return jsonify({"error": err}), 400
 
     target_alias = body.get("target_alias")
     if target_alias is not None:
-        err = validate_string_field("target_alias", target_alias, max_length=MAX_TARGET_ALIAS_LENGTH)
+        err, alias_clean = _validate_target_alias(target_alias)
         if err:
             return jsonify({"error": err}), 400
-        alias_clean = target_alias.strip()
-        if alias_clean and not ALLOWED_IDENTIFIER_RE.match(alias_clean):
-            return jsonify({"error": "target_alias contiene caracteres no permitidos"}), 400
-        body["target_alias"] = alias_clean or None
+        target_alias = alias_clean
 
-    loc_err, (normalized_type, ident_clean) = validate_location_selector(
+    loc_err, (location_type, location_identifier) = validate_location_selector(
         body.get("location_type"), body.get("location_identifier")
     )
     if loc_err:
         return jsonify({"error": loc_err}), 400
-    body["location_type"] = normalized_type
-    body["location_identifier"] = ident_clean
 
+    client_key = body["client_key"]
     corr_id = new_correlation_id()
+    g.correlation_id = corr_id
     t0 = time.perf_counter()
 
     db = request.environ.get("db_session")
 
     try:
-        creds = (
-            db.query(TenantCredentials)
-            .filter_by(client_key=body["client_key"], enabled=True)
-            .first()
+        creds, tenant_user, storage, _ = _resolve_tenant_storage(
+            db,
+            client_key,
+            target_alias=target_alias,
+            location_type=location_type,
+            location_identifier=location_identifier,
         )
         if not creds:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
-        storage_query = (
-            db.query(StorageTargets)
-            .filter_by(client_key=body["client_key"], tenant_id=creds.id)
-        )
-        target_alias = body.get("target_alias")
-        location_type = body.get("location_type")
-        location_identifier = body.get("location_identifier")
-        tenant_user = None
         if target_alias:
-            tenant_user = (
-                db.query(TenantUsers)
-                .filter_by(tenant_id=creds.id, alias=target_alias)
-                .first()
-            )
             if not tenant_user:
                 return jsonify({"error": f"target_alias '{target_alias}' no está configurado"}), 400
-            storage = storage_query.filter_by(tenant_user_id=tenant_user.id).first()
             if not storage:
                 return jsonify({"error": f"No hay destino configurado para el alias '{target_alias}'"}), 400
-        else:
-            if location_type and location_identifier:
-                storage = (
-                    storage_query
-                    .filter_by(location_type=location_type, location_identifier=location_identifier)
-                    .first()
-                )
-                if not storage:
-                    return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
-            else:
-                storage = storage_query.first()
+        elif location_type and location_identifier and not storage:
+            return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
 
         if not storage:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
@@ -741,7 +830,7 @@ def read_cells():
 
         full_dest_path = _join_storage_path(
             storage.default_dest_folder_path,
-            body["dest_file_name"],
+            dest_file_name,
         )
 
         drive_id, target_user_graph_id = _resolve_graph_target(storage)
@@ -808,7 +897,7 @@ def read_cells():
             payload["ms_request_id"] = ge.ms_request_id
         return jsonify(payload), status
 
-    except Exception as e:
+    except (SQLAlchemyError, ValueError, KeyError) as e:
         return jsonify({"error": str(e), "correlation_id": corr_id}), 500
 
 
@@ -824,94 +913,63 @@ def read_range():
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("client_key", body.get("client_key"), max_length=MAX_CLIENT_FIELD_LENGTH)
+    err = validate_string_fields(body, (
+        ("client_key", MAX_CLIENT_FIELD_LENGTH),
+        ("tenant_name", MAX_TENANT_NAME_LENGTH),
+        ("dest_file_name", MAX_DEST_FILE_NAME_LENGTH),
+    ))
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("tenant_name", body.get("tenant_name"), max_length=MAX_TENANT_NAME_LENGTH)
+    cells = body.get("cells")
+    if not isinstance(cells, list) or not cells:
+        return jsonify({"error": "cells debe ser una lista no vacía de direcciones"}), 400
+    err = validate_cell_list(cells)
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("dest_file_name", body.get("dest_file_name"), max_length=MAX_DEST_FILE_NAME_LENGTH)
+    err, dest_file_name = _validate_dest_file_name(body["dest_file_name"])
     if err:
         return jsonify({"error": err}), 400
 
-    cells = body.get("cells")
-    if not isinstance(cells, list) or not cells:
-        return jsonify({"error": "cells debe ser una lista no vacía de direcciones"}), 400
-    for cell in cells:
-        if not isinstance(cell, str) or not CELL_REF_RE.match(cell):
-            return jsonify({"error": f"Dirección de celda inválida: '{cell}'. Usa 'A1' o 'Hoja!B2'."}), 400
-
-    dest_file_name = body["dest_file_name"].strip()
-    if any(sep in dest_file_name for sep in ("/", "\\")) or dest_file_name.startswith(".") or ".." in dest_file_name:
-        return jsonify({"error": "dest_file_name inválido"}), 400
-    if not dest_file_name.lower().endswith(".xlsx"):
-        return jsonify({"error": "dest_file_name debe terminar en .xlsx"}), 400
-    body["dest_file_name"] = dest_file_name
-
     target_alias = body.get("target_alias")
     if target_alias is not None:
-        err = validate_string_field("target_alias", target_alias, max_length=MAX_TARGET_ALIAS_LENGTH)
+        err, alias_clean = _validate_target_alias(target_alias)
         if err:
             return jsonify({"error": err}), 400
-        alias_clean = target_alias.strip()
-        if alias_clean and not ALLOWED_IDENTIFIER_RE.match(alias_clean):
-            return jsonify({"error": "target_alias contiene caracteres no permitidos"}), 400
-        body["target_alias"] = alias_clean or None
+        target_alias = alias_clean
 
-    loc_err, (normalized_type, ident_clean) = validate_location_selector(
+    loc_err, (location_type, location_identifier) = validate_location_selector(
         body.get("location_type"), body.get("location_identifier")
     )
     if loc_err:
         return jsonify({"error": loc_err}), 400
-    body["location_type"] = normalized_type
-    body["location_identifier"] = ident_clean
 
+    client_key = body["client_key"]
     corr_id = new_correlation_id()
+    g.correlation_id = corr_id
     t0 = time.perf_counter()
 
     db = request.environ.get("db_session")
 
     try:
-        creds = (
-            db.query(TenantCredentials)
-            .filter_by(client_key=body["client_key"], enabled=True)
-            .first()
+        creds, tenant_user, storage, _ = _resolve_tenant_storage(
+            db,
+            client_key,
+            target_alias=target_alias,
+            location_type=location_type,
+            location_identifier=location_identifier,
         )
         if not creds:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
-        storage_query = (
-            db.query(StorageTargets)
-            .filter_by(client_key=body["client_key"], tenant_id=creds.id)
-        )
-        target_alias = body.get("target_alias")
-        location_type = body.get("location_type")
-        location_identifier = body.get("location_identifier")
-        tenant_user = None
         if target_alias:
-            tenant_user = (
-                db.query(TenantUsers)
-                .filter_by(tenant_id=creds.id, alias=target_alias)
-                .first()
-            )
             if not tenant_user:
                 return jsonify({"error": f"target_alias '{target_alias}' no está configurado"}), 400
-            storage = storage_query.filter_by(tenant_user_id=tenant_user.id).first()
             if not storage:
                 return jsonify({"error": f"No hay destino configurado para el alias '{target_alias}'"}), 400
-        else:
-            if location_type and location_identifier:
-                storage = (
-                    storage_query
-                    .filter_by(location_type=location_type, location_identifier=location_identifier)
-                    .first()
-                )
-                if not storage:
-                    return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
-            else:
-                storage = storage_query.first()
+        elif location_type and location_identifier and not storage:
+            return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
 
         if not storage:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
@@ -924,7 +982,7 @@ def read_range():
 
         full_dest_path = _join_storage_path(
             storage.default_dest_folder_path,
-            body["dest_file_name"],
+            dest_file_name,
         )
 
         drive_id, target_user_graph_id = _resolve_graph_target(storage)
@@ -961,7 +1019,7 @@ def read_range():
             payload["ms_request_id"] = ge.ms_request_id
         return jsonify(payload), status
 
-    except Exception as e:
+    except (SQLAlchemyError, ValueError, KeyError) as e:
         return jsonify({"error": str(e), "correlation_id": corr_id}), 500
 
 
@@ -977,15 +1035,11 @@ def insert_rows():
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("client_key", body.get("client_key"), max_length=MAX_CLIENT_FIELD_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("tenant_name", body.get("tenant_name"), max_length=MAX_TENANT_NAME_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("dest_file_name", body.get("dest_file_name"), max_length=MAX_DEST_FILE_NAME_LENGTH)
+    err = validate_string_fields(body, (
+        ("client_key", MAX_CLIENT_FIELD_LENGTH),
+        ("tenant_name", MAX_TENANT_NAME_LENGTH),
+        ("dest_file_name", MAX_DEST_FILE_NAME_LENGTH),
+    ))
     if err:
         return jsonify({"error": err}), 400
 
@@ -1010,19 +1064,19 @@ def insert_rows():
                 return jsonify({"error": f"rows[{idx}] debe ser una lista"}), 400
             if not row:
                 return jsonify({"error": f"rows[{idx}] no puede estar vacío"}), 400
-            for val in row:
-                if not (isinstance(val, (str, int, float, bool)) or val is None):
-                    return jsonify({"error": f"Tipo no soportado en rows[{idx}]: {type(val).__name__}"}), 400
-            max_cols = max(max_cols, len(row))
+        # Chequeo de tipos en una sola pasada; solo se recorre fila a fila para reportar el error
+        if not all(type(val) in _ROW_VALUE_TYPES for val in chain.from_iterable(rows)):
+            for idx, row in enumerate(rows):
+                for val in row:
+                    if type(val) not in _ROW_VALUE_TYPES:
+                        return jsonify({"error": f"Tipo no soportado en rows[{idx}]: {type(val).__name__}"}), 400
+        max_cols = max(map(len, rows))
         if max_cols == 0:
             return jsonify({"error": "rows debe contener al menos una columna"}), 400
 
-    dest_file_name = body["dest_file_name"].strip()
-    if any(sep in dest_file_name for sep in ("/", "\\")) or dest_file_name.startswith(".") or ".." in dest_file_name:
-        return jsonify({"error": "dest_file_name inválido"}), 400
-    if not dest_file_name.lower().endswith(".xlsx"):
-        return jsonify({"error": "dest_file_name debe terminar en .xlsx"}), 400
-    body["dest_file_name"] = dest_file_name
+    err, dest_file_name = _validate_dest_file_name(body["dest_file_name"])
+    if err:
+        return jsonify({"error": err}), 400
 
     if merge_ranges is not None:
         if not isinstance(merge_ranges, list) or not all(isinstance(r, str) for r in merge_ranges):
@@ -1030,66 +1084,42 @@ def insert_rows():
 
     target_alias = body.get("target_alias")
     if target_alias is not None:
-        err = validate_string_field("target_alias", target_alias, max_length=MAX_TARGET_ALIAS_LENGTH)
+        err, alias_clean = _validate_target_alias(target_alias)
         if err:
             return jsonify({"error": err}), 400
-        alias_clean = target_alias.strip()
-        if alias_clean and not ALLOWED_IDENTIFIER_RE.match(alias_clean):
-            return jsonify({"error": "target_alias contiene caracteres no permitidos"}), 400
-        body["target_alias"] = alias_clean or None
+        target_alias = alias_clean
 
-    loc_err, (normalized_type, ident_clean) = validate_location_selector(
+    loc_err, (location_type, location_identifier) = validate_location_selector(
         body.get("location_type"), body.get("location_identifier")
     )
     if loc_err:
         return jsonify({"error": loc_err}), 400
-    body["location_type"] = normalized_type
-    body["location_identifier"] = ident_clean
 
+    client_key = body["client_key"]
     corr_id = new_correlation_id()
+    g.correlation_id = corr_id
     t0 = time.perf_counter()
 
     db = request.environ.get("db_session")
 
     try:
-        creds = (
-            db.query(TenantCredentials)
-            .filter_by(client_key=body["client_key"], enabled=True)
-            .first()
+        creds, tenant_user, storage, _ = _resolve_tenant_storage(
+            db,
+            client_key,
+            target_alias=target_alias,
+            location_type=location_type,
+            location_identifier=location_identifier,
         )
         if not creds:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
-        storage_query = (
-            db.query(StorageTargets)
-            .filter_by(client_key=body["client_key"], tenant_id=creds.id)
-        )
-        target_alias = body.get("target_alias")
-        location_type = body.get("location_type")
-        location_identifier = body.get("location_identifier")
-        tenant_user = None
         if target_alias:
-            tenant_user = (
-                db.query(TenantUsers)
-                .filter_by(tenant_id=creds.id, alias=target_alias)
-                .first()
-            )
             if not tenant_user:
                 return jsonify({"error": f"target_alias '{target_alias}' no está configurado"}), 400
-            storage = storage_query.filter_by(tenant_user_id=tenant_user.id).first()
             if not storage:
                 return jsonify({"error": f"No hay destino configurado para el alias '{target_alias}'"}), 400
-        else:
-            if location_type and location_identifier:
-                storage = (
-                    storage_query
-                    .filter_by(location_type=location_type, location_identifier=location_identifier)
-                    .first()
-                )
-                if not storage:
-                    return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
-            else:
-                storage = storage_query.first()
+        elif location_type and location_identifier and not storage:
+            return jsonify({"error": "No hay destino configurado para la ubicación indicada"}), 400
 
         if not storage:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
@@ -1102,7 +1132,7 @@ def insert_rows():
 
         full_dest_path = _join_storage_path(
             storage.default_dest_folder_path,
-            body["dest_file_name"],
+            dest_file_name,
         )
 
         drive_id, target_user_graph_id = _resolve_graph_target(storage)
@@ -1136,7 +1166,7 @@ def insert_rows():
             payload["ms_request_id"] = ge.ms_request_id
         return jsonify(payload), status
 
-    except Exception as e:
+    except (SQLAlchemyError, ValueError, KeyError) as e:
         return jsonify({"error": str(e), "correlation_id": corr_id}), 500
 
 @graph_bp.post("/excel/find-markers")
@@ -1160,15 +1190,11 @@ def find_markers():
     if err:
         return jsonify({"error": err}), 400
 
-    err = validate_string_field("client_key", body.get("client_key"), max_length=MAX_CLIENT_FIELD_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("template_key", body.get("template_key"), max_length=MAX_TEMPLATE_KEY_LENGTH)
-    if err:
-        return jsonify({"error": err}), 400
-
-    err = validate_string_field("tenant_name", body.get("tenant_name"), max_length=MAX_TENANT_NAME_LENGTH)
+    err = validate_string_fields(body, (
+        ("client_key", MAX_CLIENT_FIELD_LENGTH),
+        ("template_key", MAX_TEMPLATE_KEY_LENGTH),
+        ("tenant_name", MAX_TENANT_NAME_LENGTH),
+    ))
     if err:
         return jsonify({"error": err}), 400
 
@@ -1185,47 +1211,26 @@ def find_markers():
         return jsonify({"error": loc_err}), 400
 
     corr_id = new_correlation_id()
+    g.correlation_id = corr_id
     db = request.environ.get("db_session")
 
     try:
-        creds = (
-            db.query(TenantCredentials)
-            .filter_by(client_key=body["client_key"], enabled=True)
-            .first()
+        creds, tenant_user, storage, template = _resolve_tenant_storage(
+            db,
+            body["client_key"],
+            target_alias=target_alias,
+            location_type=normalized_type,
+            location_identifier=ident_clean,
+            template_key=body["template_key"],
         )
         if not creds:
             return jsonify({"error": "Configuración incompleta en DB"}), 400
 
-        template = (
-            db.query(Templates)
-            .filter_by(client_key=body["client_key"], template_key=body["template_key"])
-            .first()
-        )
         if not template:
             return jsonify({"error": "Template no encontrado"}), 400
 
-        storage_query = (
-            db.query(StorageTargets)
-            .filter_by(client_key=body["client_key"], tenant_id=creds.id)
-        )
-        
-        if target_alias:
-            tenant_user = (
-                db.query(TenantUsers)
-                .filter_by(tenant_id=creds.id, alias=target_alias)
-                .first()
-            )
-            if not tenant_user:
-                return jsonify({"error": f"target_alias '{target_alias}' no configurado"}), 400
-            storage = storage_query.filter_by(tenant_user_id=tenant_user.id).first()
-        elif normalized_type and ident_clean:
-            storage = (
-                storage_query
-                .filter_by(location_type=normalized_type, location_identifier=ident_clean)
-                .first()
-            )
-        else:
-            storage = storage_query.first()
+        if target_alias and not tenant_user:
+            return jsonify({"error": f"target_alias '{target_alias}' no configurado"}), 400
 
         if not storage:
             return jsonify({"error": "No hay destino de almacenamiento configurado"}), 400
@@ -1242,46 +1247,24 @@ def find_markers():
         )
         drive_id, target_user_graph_id = _resolve_graph_target(storage)
 
-        tpl_bytes, _ = gs.download_file_bytes(
+        # Si el eTag del template no cambió, se reutilizan los marcadores ya calculados
+        item_meta, _ = gs.get_item_metadata(
             full_template_path,
             target_user_id=target_user_graph_id,
             drive_id=drive_id,
         )
-
-        from openpyxl import load_workbook
-        from openpyxl.utils import get_column_letter
-        from io import BytesIO
-
-        wb = load_workbook(BytesIO(tpl_bytes))
-        markers = []
-
-        for sheet in wb.worksheets:
-            for row in sheet.iter_rows():
-                for cell in row:
-                    if cell.value and isinstance(cell.value, str):
-                        text = str(cell.value).strip()
-                        is_marker = False
-                        
-                        if text.endswith(':'):
-                            is_marker = True
-                        elif any(keyword in text.upper() for keyword in [
-                            'DATOS', 'DETALLE', 'TOTAL', 'RESUMEN', 'CLIENTE',
-                            'PAGOS', 'ITEMS', 'PRODUCTOS', 'SERVICIOS', 'FOOTER',
-                            'HEADER', 'INFORMACIÓN'
-                        ]):
-                            is_marker = True
-                        elif text.isupper() and len(text) > 3:
-                            is_marker = True
-                        
-                        if is_marker:
-                            col_letter = get_column_letter(cell.column)
-                            markers.append({
-                                "text": text,
-                                "position": f"{col_letter}{cell.row}",
-                                "sheet": sheet.title,
-                                "row": cell.row,
-                                "column": cell.column
-                            })
+        etag = item_meta.get("eTag")
+        cache_key = (body["client_key"], template.template_key, drive_id, target_user_graph_id, full_template_path)
+        markers = _get_cached_markers(cache_key, etag)
+        if markers is None:
+            tpl_bytes, _ = gs.download_file_bytes(
+                full_template_path,
+                target_user_id=target_user_graph_id,
+                drive_id=drive_id,
+            )
+            markers = _scan_template_markers(tpl_bytes)
+            if etag:
+                _store_cached_markers(cache_key, etag, markers)
 
         return jsonify({
             "message": "OK",
@@ -1301,5 +1284,5 @@ def find_markers():
             payload["ms_request_id"] = ge.ms_request_id
         return jsonify(payload), status
 
-    except Exception as e:
+    except (SQLAlchemyError, ValueError, KeyError) as e:
         return jsonify({"error": str(e), "correlation_id": corr_id}), 500
@@ -1,11 +1,18 @@
 
-from flask import Blueprint, request, jsonify, send_file
-from io import BytesIO
-import base64
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+
+from flask import Blueprint, Response, request, jsonify
+import binascii
+import multiprocessing
+import os
+import threading
 import uuid
 
+import orjson
+
 from Services.excel_live_writer import ExcelLiveWriter
-from Services.excel_section_writer import procesar_excel_completo
+from Services.excel_section_writer import EXCEL_MIME, procesar_excel_bytes, procesar_excel_completo
 
 """
 Flask Blueprint exposing minimal Excel copy/fill endpoints.
@@ -28,13 +35,59 @@ Examples (narrative):
 
 bp = Blueprint("excel_api", __name__, url_prefix="/excel/api")
 
+# process-in-memory is CPU-bound pure Python (openpyxl) and holds the GIL; with workers > 0
+# it runs in a process pool so concurrent requests use several cores. 0 = run in the request thread.
+_EXCEL_PROCESS_WORKERS = int(os.getenv("EXCEL_PROCESS_WORKERS", 0))
+_EXCEL_POOL = None
+_EXCEL_POOL_LOCK = threading.Lock()
+
 
 def _new_cid():
-	return str(uuid.uuid4())
+	# .hex skips the dashed formatting of UUID.__str__; still a 32-character uuid4
+	return uuid.uuid4().hex
+
+
+def _excel_pool():
+	"""Lazily create the shared process pool ('spawn': forking a threaded server is unsafe)."""
+	global _EXCEL_POOL
+	with _EXCEL_POOL_LOCK:
+		if _EXCEL_POOL is None:
+			_EXCEL_POOL = ProcessPoolExecutor(
+				max_workers=_EXCEL_PROCESS_WORKERS,
+				mp_context=multiprocessing.get_context("spawn"),
+			)
+		return _EXCEL_POOL
+
+
+def _excel_endpoint(json_body=True):
+	"""Decorator with the boilerplate shared by every endpoint.
+
+	Generates the correlation id, parses the JSON body (unless `json_body` is False),
+	rejects bodies that are not a JSON object with a 400 and maps any unhandled
+	exception to the usual 500 response. The wrapped view
+	receives `(payload, cid)`, or just `(cid)` when `json_body` is False.
+	"""
+	def decorator(view):
+		@wraps(view)
+		def wrapper():
+			cid = _new_cid()
+			try:
+				if json_body:
+					payload = request.get_json(force=True)
+					# Same 400 shape as the per-field checks; avoids an AttributeError (500) on .get()
+					if not isinstance(payload, dict):
+						return jsonify({"error": "JSON body must be an object", "correlation_id": cid}), 400
+					return view(payload, cid)
+				return view(cid)
+			except Exception as e:
+				return jsonify({"error": str(e), "correlation_id": cid}), 500
+		return wrapper
+	return decorator
 
 
 @bp.route("/copy-template", methods=["POST"])
-def copy_template():
+@_excel_endpoint()
+def copy_template(payload, cid):
 	"""Copy a template into a new file for the client.
 
 	Required JSON params:
@@ -50,34 +103,29 @@ def copy_template():
 	`dest_file_name` = "Boda de Diego.xlsx" will copy the `bodas` template and create
 	a new file named "Boda de Diego.xlsx" registered under `eunoia`.
 	"""
-	cid = _new_cid()
-	try:
-		payload = request.get_json(force=True)
-		client_key = payload.get("client_key")
-		dest_file_name = payload.get("dest_file_name")
-		template_key = payload.get("template_key")
-		file_key = payload.get("file_key")
-		context_data = payload.get("context_data")
-
-		if not client_key or not dest_file_name:
-			return jsonify({"error": "client_key and dest_file_name are required", "correlation_id": cid}), 400
-
-		with ExcelLiveWriter(client_key=client_key) as writer:
-			item_id, web_url, excel_file_id = writer.copy_template(
-				dest_file_name=dest_file_name,
-				template_key=template_key,
-				file_key=file_key,
-				context_data=context_data,
-			)
+	client_key = payload.get("client_key")
+	dest_file_name = payload.get("dest_file_name")
+	template_key = payload.get("template_key")
+	file_key = payload.get("file_key")
+	context_data = payload.get("context_data")
 
-		return jsonify({"message": "OK", "item_id": item_id, "web_url": web_url, "excel_file_id": excel_file_id, "correlation_id": cid})
+	if not client_key or not dest_file_name:
+		return jsonify({"error": "client_key and dest_file_name are required", "correlation_id": cid}), 400
 
-	except Exception as e:
-		return jsonify({"error": str(e), "correlation_id": cid}), 500
+	with ExcelLiveWriter(client_key=client_key) as writer:
+		item_id, web_url, excel_file_id = writer.copy_template(
+			dest_file_name=dest_file_name,
+			template_key=template_key,
+			file_key=file_key,
+			context_data=context_data,
+		)
+
+	return jsonify({"message": "OK", "item_id": item_id, "web_url": web_url, "excel_file_id": excel_file_id, "correlation_id": cid})
 
 
 @bp.route("/fill-section", methods=["POST"])
-def fill_section():
+@_excel_endpoint()
+def fill_section(payload, cid):
 	"""Fill a simple key-value section in an existing file.
 
 	Required JSON params:
@@ -90,28 +138,26 @@ def fill_section():
 	endpoint with `file_key` set to the created file and `datos` containing
 	{"nombre": "Boda de Diego", "fecha": "2026-02-14"} to populate the header row.
 	"""
-	cid = _new_cid()
-	try:
-		payload = request.get_json(force=True)
-		client_key = payload.get("client_key")
-		file_key = payload.get("file_key")
-		section_key = payload.get("section_key")
-		datos = payload.get("datos")
+	client_key = payload.get("client_key")
+	file_key = payload.get("file_key")
+	section_key = payload.get("section_key")
+	datos = payload.get("datos")
 
-		if not client_key or not file_key or datos is None:
-			return jsonify({"error": "client_key, file_key and datos are required", "correlation_id": cid}), 400
+	if not client_key or not file_key or datos is None:
+		return jsonify({"error": "client_key, file_key and datos are required", "correlation_id": cid}), 400
+	if datos == {}:
+		# Nothing to write: skip the DB lookup, token and Graph round-trips
+		return jsonify({"message": "OK", "written_fields": 0, "correlation_id": cid})
 
-		with ExcelLiveWriter(client_key=client_key) as writer:
-			writer.llenar_seccion(file_key=file_key, datos=datos, section_key=section_key)
+	with ExcelLiveWriter(client_key=client_key) as writer:
+		writer.llenar_seccion(file_key=file_key, datos=datos, section_key=section_key)
 
-		return jsonify({"message": "OK", "written_fields": len(datos) if isinstance(datos, dict) else None, "correlation_id": cid})
-
-	except Exception as e:
-		return jsonify({"error": str(e), "correlation_id": cid}), 500
+	return jsonify({"message": "OK", "written_fields": len(datos) if isinstance(datos, dict) else None, "correlation_id": cid})
 
 
 @bp.route("/fill-table", methods=["POST"])
-def fill_table():
+@_excel_endpoint()
+def fill_table(payload, cid):
 	"""Fill a table section (multiple rows) in an existing file.
 
 	Required JSON params:
@@ -124,28 +170,25 @@ def fill_table():
 	`section_key` = "invitados" and `datos` = [ {"nombre": "Ana", "asistira": true}, ... ]
 	to write the guest list table into the sheet.
 	"""
-	cid = _new_cid()
-	try:
-		payload = request.get_json(force=True)
-		client_key = payload.get("client_key")
-		file_key = payload.get("file_key")
-		section_key = payload.get("section_key")
-		datos = payload.get("datos")
-
-		if not client_key or not file_key or not isinstance(datos, list):
-			return jsonify({"error": "client_key, file_key and datos (list) are required", "correlation_id": cid}), 400
+	client_key = payload.get("client_key")
+	file_key = payload.get("file_key")
+	section_key = payload.get("section_key")
+	datos = payload.get("datos")
 
-		with ExcelLiveWriter(client_key=client_key) as writer:
-			writer.llenar_tabla(file_key=file_key, datos=datos, section_key=section_key)
+	if not client_key or not file_key or not isinstance(datos, list):
+		return jsonify({"error": "client_key, file_key and datos (list) are required", "correlation_id": cid}), 400
+	if not datos:
+		return jsonify({"message": "OK", "rows_written": 0, "correlation_id": cid})
 
-		return jsonify({"message": "OK", "rows_written": len(datos), "correlation_id": cid})
+	with ExcelLiveWriter(client_key=client_key) as writer:
+		writer.llenar_tabla(file_key=file_key, datos=datos, section_key=section_key)
 
-	except Exception as e:
-		return jsonify({"error": str(e), "correlation_id": cid}), 500
+	return jsonify({"message": "OK", "rows_written": len(datos), "correlation_id": cid})
 
 
 @bp.route("/process", methods=["POST"])
-def process_excel():
+@_excel_endpoint()
+def process_excel(payload, cid):
 	"""Process multiple sections in an existing file.
 
 	Required JSON params:
@@ -157,31 +200,28 @@ def process_excel():
 	secciones={"header": {"nombre": "Boda de Diego"}, "invitados": [ ... ]}
 	which will call the appropriate fill methods for each configured section.
 	"""
-	cid = _new_cid()
-	try:
-		payload = request.get_json(force=True)
-		client_key = payload.get("client_key")
-		file_key = payload.get("file_key")
-		secciones = payload.get("secciones")
-
-		if not client_key or not file_key or secciones is None:
-			return jsonify({"error": "client_key, file_key and secciones are required", "correlation_id": cid}), 400
+	client_key = payload.get("client_key")
+	file_key = payload.get("file_key")
+	secciones = payload.get("secciones")
 
-		with ExcelLiveWriter(client_key=client_key) as writer:
-			writer.procesar_excel(file_key=file_key, secciones=secciones)
+	if not client_key or not file_key or secciones is None:
+		return jsonify({"error": "client_key, file_key and secciones are required", "correlation_id": cid}), 400
+	if secciones == {}:
+		return jsonify({"message": "OK", "processed_sections": 0, "correlation_id": cid})
 
-		return jsonify({"message": "OK", "processed_sections": len(secciones), "correlation_id": cid})
+	with ExcelLiveWriter(client_key=client_key) as writer:
+		writer.procesar_excel(file_key=file_key, secciones=secciones)
 
-	except Exception as e:
-		return jsonify({"error": str(e), "correlation_id": cid}), 500
+	return jsonify({"message": "OK", "processed_sections": len(secciones), "correlation_id": cid})
 
 
 @bp.route("/process-in-memory", methods=["POST"])
-def process_in_memory():
+@_excel_endpoint(json_body=False)
+def process_in_memory(cid):
 	"""Process a template in-memory and return the filled Excel file.
 
 	Two options to provide the template:
-	1) Multipart/form-data upload:
+	1) Multipart/form-data upload (preferred: the file travels as raw binary, no base64 step):
 		- field `template` (file): the .xlsx template file (required)
 		- field `secciones` (string): JSON string of sections (required)
 		- field `configuracion` (string): JSON string describing markers/columns (required)
@@ -196,50 +236,56 @@ def process_in_memory():
 	.xlsx file (attachment), e.g. a filled "Boda de Diego.xlsx" file.
 	"""
 
-	cid = _new_cid()
-	try:
-		# Support multipart file upload (field 'template') or JSON base64 (template_b64)
-		secciones = None
-		configuracion = None
-
-		if request.content_type and request.content_type.startswith("multipart/"):
-			template_file = request.files.get("template")
-			secciones_raw = request.form.get("secciones")
-			configuracion_raw = request.form.get("configuracion")
-
-			if template_file:
-				template_bytes = template_file.read()
-			else:
-				return jsonify({"error": "template file not provided", "correlation_id": cid}), 400
-
-			if secciones_raw:
-				import json
-				secciones = json.loads(secciones_raw)
-			if configuracion_raw:
-				import json
-				configuracion = json.loads(configuracion_raw)
+	# Support multipart file upload (field 'template') or JSON base64 (template_b64)
+	secciones = None
+	configuracion = None
 
+	if request.content_type and request.content_type.startswith("multipart/"):
+		template_file = request.files.get("template")
+		secciones_raw = request.form.get("secciones")
+		configuracion_raw = request.form.get("configuracion")
+
+		if template_file:
+			# Werkzeug already spooled the upload to a temp file; pass its stream instead of copying it to bytes
+			template_bytes = template_file.stream
 		else:
-			payload = request.get_json(force=True)
-			template_b64 = payload.get("template_b64")
-			secciones = payload.get("secciones")
-			configuracion = payload.get("configuracion")
+			return jsonify({"error": "template file not provided", "correlation_id": cid}), 400
+
+		# get_json/jsonify already use orjson through app.json; parse the form fields the same way
+		if secciones_raw:
+			secciones = orjson.loads(secciones_raw)
+		if configuracion_raw:
+			configuracion = orjson.loads(configuracion_raw)
+
+	else:
+		payload = request.get_json(force=True)
+		if not isinstance(payload, dict):
+			return jsonify({"error": "JSON body must be an object", "correlation_id": cid}), 400
+		template_b64 = payload.get("template_b64")
+		secciones = payload.get("secciones")
+		configuracion = payload.get("configuracion")
 
-			if not template_b64:
-				return jsonify({"error": "template_b64 is required when not uploading multipart file", "correlation_id": cid}), 400
+		if not template_b64:
+			return jsonify({"error": "template_b64 is required when not uploading multipart file", "correlation_id": cid}), 400
 
-			template_bytes = base64.b64decode(template_b64)
+		# a2b_base64 takes the ASCII str directly; b64decode would first copy it to bytes
+		template_bytes = binascii.a2b_base64(template_b64)
 
-		if secciones is None or configuracion is None:
-			return jsonify({"error": "secciones and configuracion are required", "correlation_id": cid}), 400
+	if secciones is None or configuracion is None:
+		return jsonify({"error": "secciones and configuracion are required", "correlation_id": cid}), 400
 
-		# Process in-memory and return file bytes
-		output_io = procesar_excel_completo(template_bytes=template_bytes, secciones=secciones, configuracion=configuracion)
+	filename = "processed.xlsx"
+	headers = {"Content-Disposition": f"attachment; filename={filename}"}
 
-		output_io.seek(0)
-		filename = "processed.xlsx"
-		return send_file(output_io, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", as_attachment=True, download_name=filename)
+	if _EXCEL_PROCESS_WORKERS:
+		# Only bytes cross the process boundary; the uploaded stream is read once here
+		if not isinstance(template_bytes, bytes):
+			template_bytes = template_bytes.read()
+		output = _excel_pool().submit(procesar_excel_bytes, template_bytes, secciones, configuracion).result()
+	else:
+		# Serialized in full before responding: a save error must still map to the JSON 500,
+		# which a streamed body cannot do once the 200 status line has been sent
+		output = procesar_excel_completo(template_bytes=template_bytes, secciones=secciones, configuracion=configuracion).getvalue()
+	return Response(output, mimetype=EXCEL_MIME, headers=headers)
 
-	except Exception as e:
-		return jsonify({"error": str(e), "correlation_id": cid}), 500
 
@@ -1,7 +1,8 @@
 import re
+import string
 import uuid
-from datetime import datetime
-from string import Formatter
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
 
 MAX_CLIENT_FIELD_LENGTH = 100
@@ -24,9 +25,24 @@ MAX_FIELDS_PER_ROW = 50
 
 ALLOWED_IDENTIFIER_RE = re.compile(r"^[A-Za-z0-9._-]+$")
 CELL_REF_RE = re.compile(r"^(?:([^!]+)!)?([A-Za-z]+[1-9][0-9]*)$")
-DRIVE_ID_PATTERN = re.compile(r"^[A-Za-z0-9!._-]{16,}$")
-USER_GUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE)
-USER_UPN_PATTERN = re.compile(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$")
+# Variante para validar una lista completa de direcciones unidas por "\n" en una sola pasada
+_CELL_REF_ITEM = r"(?:[^!\n]+!)?[A-Za-z]+[1-9][0-9]*"
+CELL_REF_LIST_RE = re.compile(rf"(?:{_CELL_REF_ITEM}\n)*{_CELL_REF_ITEM}")
+# Sin ^/$: se usan con fullmatch, que ancla ambos extremos (y no acepta un "\n" final como $)
+DRIVE_ID_PATTERN = re.compile(r"[A-Za-z0-9!._-]{16,}")
+USER_GUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
+USER_UPN_PATTERN = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+_CELL_VALUE_TYPES = (str, int, float, bool)
+# Campos de un patrón str.format: "{{" y "}}" se consumen primero (llaves literales) y el
+# nombre llega hasta "!", ":" o "}", igual que en string.Formatter.parse
+_FIELD_RE = re.compile(r"\{\{|\}\}|\{([^{}!:]*)")
+# Caracteres no permitidos en nombres de archivo (cada tramo se reemplaza por "_")
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+# Mismo conjunto que ALLOWED_IDENTIFIER_RE / _SANITIZE_RE, para chequeos sin regex
+_ALLOWED_CHARS_STR = string.ascii_letters + string.digits + "._-"
+_ALLOWED_CHARS = frozenset(_ALLOWED_CHARS_STR)
+# Tabla que borra los caracteres permitidos: si no queda nada, no hay nada que reemplazar
+_SANITIZE_ALLOWED_DELETE = str.maketrans("", "", _ALLOWED_CHARS_STR)
 
 
 def require_fields(body, keys):
@@ -37,7 +53,8 @@ def require_fields(body, keys):
 
 
 def new_correlation_id():
-    return str(uuid.uuid4())
+    # hex evita el formateo con guiones de UUID.__str__; mismo formato que routes2._new_cid
+    return uuid.uuid4().hex
 
 
 def validate_string_field(field_name: str, value, *, max_length: int):
@@ -48,43 +65,118 @@ def validate_string_field(field_name: str, value, *, max_length: int):
     return None
 
 
-def validate_data_dict(data):
+def validate_string_fields(body, limits):
+    """Valida de una vez varios campos string; limits es una secuencia de (campo, max_length)."""
+    for field_name, max_length in limits:
+        err = validate_string_field(field_name, body.get(field_name), max_length=max_length)
+        if err:
+            return err
+    return None
+
+
+def _validate_data_shape(data):
     if not isinstance(data, dict):
         return "data debe ser un diccionario"
     if not data:
         return "data no puede estar vacío"
     if len(data) > MAX_DATA_ENTRIES:
         return f"data excede el máximo de {MAX_DATA_ENTRIES} celdas"
+    return None
+
+
+def _data_value_length(key, value):
+    """Largo en caracteres de un valor de data, o el mensaje de error (str) si no es válido."""
+    if isinstance(value, str):
+        length = len(value)
+        if length > MAX_DATA_VALUE_LENGTH:
+            return f"Valor de '{key}' excede {MAX_DATA_VALUE_LENGTH} caracteres"
+        return length
+    if value is None:
+        return 4  # len("None")
+    if value is True or value is False:
+        return 4 if value else 5  # len("True") / len("False"), sin construir el str
+    if isinstance(value, (int, float)):
+        return len(str(value))
+    return f"Tipo no soportado para '{key}': {type(value).__name__}"
+
+
+def validate_data_dict(data):
+    err = _validate_data_shape(data)
+    if err:
+        return err
 
     total_chars = 0
     for key, value in data.items():
-        if isinstance(value, str):
-            if len(value) > MAX_DATA_VALUE_LENGTH:
-                return f"Valor de '{key}' excede {MAX_DATA_VALUE_LENGTH} caracteres"
-            total_chars += len(value)
-        elif isinstance(value, (int, float, bool)) or value is None:
-            total_chars += len(str(value))
-        else:
-            return f"Tipo no soportado para '{key}': {type(value).__name__}"
+        length = _data_value_length(key, value)
+        if isinstance(length, str):
+            return length
+        total_chars += length
+        if total_chars > MAX_DATA_TOTAL_LENGTH:
+            return f"Suma total de caracteres en data excede {MAX_DATA_TOTAL_LENGTH}"
+    return None
+
+
+def validate_data_and_cells(data) -> Optional[str]:
+    """
+    validate_data_dict + validate_cell_map_or_raise en una sola pasada sobre data.
+    Devuelve None o el mensaje de error (los mismos mensajes que ambas funciones).
+    """
+    err = _validate_data_shape(data)
+    if err:
+        return err
+
+    match = CELL_REF_RE.match
+    total_chars = 0
+    for cell, value in data.items():
+        if not isinstance(cell, str) or not (_is_simple_a1(cell) or match(cell) is not None):
+            return f"Dirección de celda inválida: '{cell}'. Usa 'A1' o 'Hoja!B2'."
+        length = _data_value_length(cell, value)
+        if isinstance(length, str):
+            return length
+        total_chars += length
         if total_chars > MAX_DATA_TOTAL_LENGTH:
             return f"Suma total de caracteres en data excede {MAX_DATA_TOTAL_LENGTH}"
     return None
 
 
-def pattern_fields(pattern: str) -> set[str]:
-    formatter = Formatter()
-    return {field for _, field, _, _ in formatter.parse(pattern) if field}
+def _is_simple_a1(cell: str) -> bool:
+    """
+    Chequeo sin regex para el caso habitual "A1"/"AB12" (sin hoja): letras ASCII y luego
+    un número sin cero inicial. Si devuelve False se decide con CELL_REF_RE.
+    """
+    letters = cell.rstrip(string.digits)
+    return letters.isalpha() and letters.isascii() and cell[len(letters):len(letters) + 1] not in ("", "0")
+
+
+def _sanitize(value: str) -> str:
+    # Camino rápido para nombres ya limpios (el caso habitual). translate no sirve para
+    # reemplazar: el regex colapsa cada tramo de caracteres inválidos en un solo "_"
+    if not value.translate(_SANITIZE_ALLOWED_DELETE):
+        return value.strip("_")
+    return _SANITIZE_RE.sub("_", value).strip("_")
+
+
+@lru_cache(maxsize=512)
+def pattern_fields(pattern: str) -> frozenset[str]:
+    # Los patrones vienen de los templates (pocos y repetidos): se parsean una vez.
+    # frozenset porque el resultado cacheado se comparte entre llamadas.
+    return frozenset(field for field in _FIELD_RE.findall(pattern) if field)
+
+
+_DEFAULT_PATTERN = "{template_key}_{tenant_name_sanitized}.xlsx"
+_TIMESTAMP_PATTERN = "{template_key}_{tenant_name_sanitized}_{timestamp}.xlsx"
+_TIMESTAMP_FIELDS = pattern_fields(_TIMESTAMP_PATTERN)
 
 
 def build_dest_file_name(template, body, *, naming_provided: bool = False) -> str:
-    pattern = (template.dest_file_pattern or "{template_key}_{tenant_name_sanitized}.xlsx").strip()
+    pattern = (template.dest_file_pattern or _DEFAULT_PATTERN).strip()
     if not pattern:
-        pattern = "{template_key}_{tenant_name_sanitized}.xlsx"
+        pattern = _DEFAULT_PATTERN
 
     if "tenant_name" not in body:
         raise ValueError("Debe proporcionarse tenant_name")
     raw_tenant_name = str(body["tenant_name"]).strip()
-    tenant_name_sanitized = re.sub(r"[^A-Za-z0-9._-]+", "_", raw_tenant_name).strip("_")
+    tenant_name_sanitized = _sanitize(raw_tenant_name)
     if not tenant_name_sanitized:
         tenant_name_sanitized = "tenant"
 
@@ -105,21 +197,28 @@ def build_dest_file_name(template, body, *, naming_provided: bool = False) -> st
     if missing:
         if naming_provided:
             raise ValueError(f"Faltan campos para naming: {', '.join(missing)}")
-        context.setdefault("timestamp", datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
-        pattern = "{template_key}_{tenant_name_sanitized}_{timestamp}.xlsx"
-        required = pattern_fields(pattern)
+        if "timestamp" not in context:
+            context["timestamp"] = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        pattern = _TIMESTAMP_PATTERN
+        required = _TIMESTAMP_FIELDS
         missing = [k for k in required if k not in context]
         if missing:
             raise ValueError("No se pudo construir nombre de archivo")
+    # Sin faltantes, {timestamp} (si el patrón lo usa) ya viene en naming: no hace falta generarlo
+
+    # Patrones por defecto (el caso habitual): se arman directo, sin pasar por str.format.
+    # Se leen de context porque naming puede sobrescribir template_key/tenant_name_sanitized.
+    if pattern == _DEFAULT_PATTERN:
+        raw_name = f"{context['template_key']}_{context['tenant_name_sanitized']}.xlsx"
+    elif pattern == _TIMESTAMP_PATTERN:
+        raw_name = f"{context['template_key']}_{context['tenant_name_sanitized']}_{context['timestamp']}.xlsx"
     else:
-        context.setdefault("timestamp", datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
+        try:
+            raw_name = pattern.format(**context)
+        except Exception as exc:
+            raise ValueError(f"dest_file_pattern inválido: {exc}") from exc
 
-    try:
-        raw_name = pattern.format(**context)
-    except Exception as exc:
-        raise ValueError(f"dest_file_pattern inválido: {exc}") from exc
-
-    sanitized = re.sub(r"[^A-Za-z0-9._-]+", "_", str(raw_name)).strip("_")
+    sanitized = _sanitize(raw_name)
     if not sanitized:
         sanitized = "archivo"
     if not sanitized.lower().endswith(".xlsx"):
@@ -149,7 +248,7 @@ def validate_naming_dict(naming):
         key = raw_key.strip()
         if len(key) > MAX_NAMING_KEY_LENGTH:
             return f"Clave '{key}' excede {MAX_NAMING_KEY_LENGTH} caracteres", {}
-        if not ALLOWED_IDENTIFIER_RE.match(key):
+        if not _ALLOWED_CHARS.issuperset(key):
             return f"Clave '{key}' contiene caracteres no permitidos", {}
 
         value = raw_value
@@ -169,13 +268,28 @@ def validate_cell_map_or_raise(data):
     if not isinstance(data, dict) or not data:
         raise ValueError("data debe ser un diccionario no vacío de {celda: valor}.")
 
+    # Alias locales: evitan la búsqueda de atributo/global en cada una de hasta MAX_DATA_ENTRIES celdas
+    match = CELL_REF_RE.match
+    scalar_types = _CELL_VALUE_TYPES
     for cell, value in data.items():
-        if not isinstance(cell, str) or not CELL_REF_RE.match(cell):
+        if not isinstance(cell, str) or not (_is_simple_a1(cell) or match(cell) is not None):
             raise ValueError(f"Dirección de celda inválida: '{cell}'. Usa 'A1' o 'Hoja!B2'.")
-        if not (isinstance(value, (str, int, float, bool)) or value is None):
+        if value is not None and not isinstance(value, scalar_types):
             raise ValueError(f"Valor no soportado para '{cell}': {type(value).__name__}")
 
 
+def validate_cell_list(cells):
+    """Valida una lista de direcciones de celda; devuelve None o el mensaje de error."""
+    # Una celda con "\n" partiría en dos ítems válidos al unir ("A1\nB2"): esas van al camino lento
+    if all(isinstance(cell, str) and "\n" not in cell for cell in cells) and CELL_REF_LIST_RE.fullmatch("\n".join(cells)):
+        return None
+    # Camino lento solo para identificar la primera dirección inválida
+    for cell in cells:
+        if not isinstance(cell, str) or not CELL_REF_RE.match(cell):
+            return f"Dirección de celda inválida: '{cell}'. Usa 'A1' o 'Hoja!B2'."
+    return None
+
+
 def validate_location_selector(location_type, location_identifier):
     if location_type is None and location_identifier is None:
         return None, (None, None)
@@ -196,10 +310,10 @@ def validate_location_selector(location_type, location_identifier):
         return f"location_identifier excede {MAX_LOCATION_IDENTIFIER_LENGTH} caracteres", (None, None)
 
     if normalized_type == "drive":
-        if not DRIVE_ID_PATTERN.match(ident_clean):
+        if not DRIVE_ID_PATTERN.fullmatch(ident_clean):
             return "location_identifier para drive no tiene formato válido", (None, None)
     else:
-        if not (USER_GUID_PATTERN.match(ident_clean) or USER_UPN_PATTERN.match(ident_clean)):
+        if not (USER_GUID_PATTERN.fullmatch(ident_clean) or USER_UPN_PATTERN.fullmatch(ident_clean)):
             return "location_identifier para user debe ser GUID o UPN", (None, None)
 
     return None, (normalized_type, ident_clean)